@@ -0,0 +1,157 @@
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import random
+import sys
+import time
+
+# Episodes never open a window
+os.environ["SDL_VIDEODRIVER"] = "dummy"
+os.environ["SDL_AUDIODRIVER"] = "dummy"
+
+import pygame
+import main
+
+POLICIES = ["idle", "random", "seek"]
+# Keys the scripted policies press, up/down/left/right
+MOVE_KEYS = [pygame.K_w, pygame.K_s, pygame.K_a, pygame.K_d]
+
+
+class ScriptedInput:
+    # Plays the fly instead of a keyboard, plugs into Game.input_source
+    def __init__(self, policy, seed):
+        self.policy = policy
+        # own generator so the policy doesn't shift the level generation random sequence
+        self.rng = random.Random(seed)
+        self.held = frozenset()
+
+    def apply(self, game):
+        if self.policy == "random":
+            # hold a random direction for a few ticks at a time
+            if self.rng.random() < 0.1:
+                self.held = frozenset(key for key in MOVE_KEYS if self.rng.random() < 0.3)
+        elif self.policy == "seek":
+            self.held = self.seek(game.world)
+        game.keys_down = main.KeyState(self.held)
+        game.keys_clicked = {}
+
+    def seek(self, world):
+        # heads straight for the nearest spark, walls and all
+        x, y = world.fly.position
+        target = None
+        best = math.inf
+        for entity in world.entities.values():
+            if isinstance(entity, main.Spark):
+                distance = (entity.position[0] - x) ** 2 + (entity.position[1] - y) ** 2
+                if distance < best:
+                    best = distance
+                    target = entity.position
+        if target is None:
+            return frozenset()
+        keys = set()
+        if target[1] < y - 2:
+            keys.add(pygame.K_w)
+        elif target[1] > y + 2:
+            keys.add(pygame.K_s)
+        if target[0] < x - 2:
+            keys.add(pygame.K_a)
+        elif target[0] > x + 2:
+            keys.add(pygame.K_d)
+        return frozenset(keys)
+
+
+def run_episode(job):
+    seed, ticks, policy = job
+    random.seed(seed)
+    world = main.World()
+    game = main.Game(headless=True, world=world)
+    # everything happens on this process' one thread, keeps the seeded level sequence reproducible
+    game.preloader = None
+    game.input_source = ScriptedInput(policy, seed)
+    start = time.perf_counter()
+    game.init()
+    game.run_headless(ticks)
+    seconds = time.perf_counter() - start
+    result = {
+        "seed": seed,
+        "pid": os.getpid(),
+        "ticks": game.tick_count,
+        "seconds": seconds,
+        "levels_completed": world.level_count,
+        # the game stops itself once the last level is cleared
+        "finished": not game.running,
+        "sparks": world.fly.sparkCount,
+        "level_sparks": world.spark_count,
+        "deaths": world.fly.deathCount,
+    }
+    # hands the level's entities back to this worker's pool for the next episode
+    world.clear()
+    return result
+
+
+def summarize(results):
+    workers = {}
+    for result in results:
+        worker = workers.setdefault(result["pid"], {"episodes": 0, "ticks": 0, "seconds": 0.0})
+        worker["episodes"] += 1
+        worker["ticks"] += result["ticks"]
+        worker["seconds"] += result["seconds"]
+    for worker in workers.values():
+        worker["ticks_per_second"] = worker["ticks"] / worker["seconds"] if worker["seconds"] else 0.0
+    episodes = len(results)
+    # a finished level counts fully, the one still being played by the share of its sparks collected
+    completion = [result["levels_completed"] + (result["sparks"] / result["level_sparks"]
+                                                if result["level_sparks"] and not result["finished"] else 0)
+                  for result in results]
+    return {
+        "episodes": episodes,
+        "ticks": sum(result["ticks"] for result in results),
+        "mean_levels_completed": sum(completion) / episodes if episodes else 0.0,
+        "mean_deaths": sum(result["deaths"] for result in results) / episodes if episodes else 0.0,
+        "workers": {str(pid): worker for pid, worker in sorted(workers.items())},
+    }
+
+
+def run(episodes, ticks, workers, seed, policy):
+    jobs = [(seed + i, ticks, policy) for i in range(episodes)]
+    start = time.perf_counter()
+    pool = multiprocessing.Pool(workers)
+    # episodes differ a lot in length, so hand them out one at a time
+    results = sorted(pool.imap_unordered(run_episode, jobs), key=lambda result: result["seed"])
+    # SDL turns SIGTERM into a quit event, so the workers are let finish instead of terminated
+    pool.close()
+    pool.join()
+    wall_time = time.perf_counter() - start
+    summary = summarize(results)
+    summary["wall_seconds"] = wall_time
+    summary["ticks_per_second"] = summary["ticks"] / wall_time
+    summary["policy"] = policy
+    return {"summary": summary, "episodes": results}
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Run many headless SparkFly episodes across all cores")
+    parser.add_argument("--episodes", type=int, default=100)
+    parser.add_argument("--ticks", type=int, default=3600, help="ticks per episode, 3600 is a minute of play")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="processes to run, defaults to one per core")
+    parser.add_argument("--seed", type=int, default=0, help="episode i uses seed + i")
+    parser.add_argument("--policy", choices=POLICIES, default="seek")
+    parser.add_argument("--output", help="where to write the per episode results as JSON")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args(sys.argv[1:])
+    report = run(args.episodes, args.ticks, args.workers, args.seed, args.policy)
+    summary = report["summary"]
+    for pid, worker in summary["workers"].items():
+        print("worker %7s %5d episodes %9d ticks %10.1f ticks/s" % (
+            pid, worker["episodes"], worker["ticks"], worker["ticks_per_second"]))
+    print("%d episodes in %.2f s, %.1f ticks/s overall, %.2f levels completed and %.2f deaths per episode" % (
+        summary["episodes"], summary["wall_seconds"], summary["ticks_per_second"],
+        summary["mean_levels_completed"], summary["mean_deaths"]))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
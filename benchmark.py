@@ -0,0 +1,172 @@
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+
+# The benchmark never opens a window
+os.environ["SDL_VIDEODRIVER"] = "dummy"
+os.environ["SDL_AUDIODRIVER"] = "dummy"
+
+import pygame
+import main
+
+# Multiples of the default map area that get benchmarked
+AREA_SCALES = [1, 2, 5, 10]
+# Metrics where bigger is better, everything else is a time where smaller is better
+RATE_METRICS = {"ticks_per_second", "frames_per_second"}
+
+
+def median_time(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return times[len(times) // 2]
+
+
+def reset_world(world):
+    world.clear()
+    world.level_count = 0
+    world.fly.deathCount = 0
+
+
+def bench_size(game, width, height, seed, ticks, frames, repeat):
+    main.MAP_WIDTH = width
+    main.MAP_HEIGHT = height
+
+    gen_map_time = median_time(lambda: main.gen_map(width, height, seed), repeat)
+
+    def build_world(path=None):
+        reset_world(game.world)
+        main.create_world(game.world, path)
+
+    random.seed(seed)
+    create_world_time = median_time(build_world, repeat)
+
+    level_path = os.path.join(tempfile.gettempdir(), "sparkfly-benchmark-%d.level" % os.getpid())
+    main.save_level(level_path, width, height, seed, main.gen_map(width, height, seed))
+    try:
+        load_world_time = median_time(lambda: build_world(level_path), repeat)
+    finally:
+        reset_world(game.world)
+        os.remove(level_path)
+
+    # the timed runs start from the same seeded level every time
+    random.seed(seed)
+    build_world()
+    game.invalidate_static_layer()
+    entity_count = len(game.world.entities)
+    game.poll_input()
+    start = time.perf_counter()
+    for _ in range(ticks):
+        game.tick()
+    tick_time = time.perf_counter() - start
+
+    game.clear()
+    game.render()
+    start = time.perf_counter()
+    for _ in range(frames):
+        game.clear()
+        game.render()
+    frame_time = time.perf_counter() - start
+
+    return {
+        "map_width": width,
+        "map_height": height,
+        "entities": entity_count,
+        "gen_map_ms": gen_map_time * 1000,
+        "create_world_ms": create_world_time * 1000,
+        "load_world_ms": load_world_time * 1000,
+        "ticks_per_second": ticks / tick_time,
+        "frames_per_second": frames / frame_time,
+    }
+
+
+def run(seed, ticks, frames, repeat, scales):
+    default_width, default_height = main.MAP_WIDTH, main.MAP_HEIGHT
+    game = main.Game(headless=True)
+    # a level built in the background would consume the seeded random module while we measure
+    game.preloader = None
+    random.seed(seed)
+    game.init()
+    results = []
+    try:
+        for scale in scales:
+            width = round(default_width * math.sqrt(scale))
+            height = round(default_height * math.sqrt(scale))
+            result = bench_size(game, width, height, seed, ticks, frames, repeat)
+            result["scale"] = scale
+            results.append(result)
+            print(("%4dx%-4d %6d entities  gen_map %8.2f ms  create_world %8.2f ms  from file %8.2f ms  "
+                   "%8.1f ticks/s  %8.1f frames/s") % (
+                width, height, result["entities"], result["gen_map_ms"], result["create_world_ms"],
+                result["load_world_ms"], result["ticks_per_second"], result["frames_per_second"]))
+    finally:
+        main.MAP_WIDTH, main.MAP_HEIGHT = default_width, default_height
+    return {
+        "seed": seed,
+        "ticks": ticks,
+        "frames": frames,
+        "python": platform.python_version(),
+        "pygame": pygame.version.ver,
+        "results": results,
+    }
+
+
+def compare(report, baseline, threshold):
+    # returns the list of metrics that got worse than the baseline by more than threshold (a fraction)
+    regressions = []
+    baseline_results = {result["scale"]: result for result in baseline["results"]}
+    for result in report["results"]:
+        previous = baseline_results.get(result["scale"])
+        if previous is None:
+            continue
+        for metric, value in result.items():
+            if not metric.endswith("_ms") and metric not in RATE_METRICS:
+                continue
+            old = previous.get(metric)
+            if not old:
+                continue
+            if metric in RATE_METRICS:
+                change = (old - value) / old
+            else:
+                change = (value - old) / old
+            if change > threshold:
+                regressions.append("scale %g %s: %.2f -> %.2f (%+.1f%%)" % (
+                    result["scale"], metric, old, value, change * 100))
+    return regressions
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Headless SparkFly performance benchmark")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--ticks", type=int, default=300)
+    parser.add_argument("--frames", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=5, help="runs of gen_map/create_world, the median is kept")
+    parser.add_argument("--scales", type=float, nargs="+", default=AREA_SCALES,
+                        help="map areas to benchmark as multiples of the default map")
+    parser.add_argument("--output", default="benchmark.json", help="where to write the report")
+    parser.add_argument("--baseline", help="report to compare against")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="allowed slowdown against the baseline, 0.1 is 10%%")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args(sys.argv[1:])
+    report = run(args.seed, args.ticks, args.frames, args.repeat, args.scales)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.threshold)
+        for regression in regressions:
+            print("REGRESSION " + regression)
+        sys.exit(1 if regressions else 0)
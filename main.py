@@ -1,6 +1,21 @@
 import os
+import sys
+import mmap
+import time
 import pygame
 import random
+import hashlib
+import itertools
+import json
+import struct
+import threading
+import queue
+from collections import OrderedDict, deque
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 
 def point_in_circle(px: int, py: int, cx: int, cy: int, radius: int):
@@ -8,9 +23,10 @@ def point_in_circle(px: int, py: int, cx: int, cy: int, radius: int):
 
 
 def circle_circle_(circle_a: (int, int, int), circle_b: (int, int, int)):
-    distance = (circle_a[0] - circle_b[0], circle_a[1] - circle_b[1])
+    distance_x = circle_a[0] - circle_b[0]
+    distance_y = circle_a[1] - circle_b[1]
     radius = circle_a[2] + circle_b[2]
-    return distance[0] ** 2 + distance[1] ** 2 <= radius ** 2
+    return distance_x ** 2 + distance_y ** 2 <= radius ** 2
 
 
 def box_in_box(box_a: (int, int, int, int), box_b: (int, int, int, int)):
@@ -44,7 +60,18 @@ class ShapeType:
     Box_ = 11
 
 
+# Bit flags, a shape only reacts to shapes whose layer is in its mask
+class CollisionLayer:
+    None_ = 0
+    Default_ = 1
+    Static_ = 2
+    Player_ = 4
+    All_ = 0xffff
+
+
 class Component:
+    __slots__ = ("component_type", "entity")
+
     def __init__(self, component_type):
         self.component_type = component_type
         self.entity = None
@@ -60,45 +87,85 @@ def _default_on_collide(shape_a, shape_b):
     pass
 
 
+# shared by every shape until it ignores something, saves a set per shape
+_NO_IGNORED_ENTITIES = frozenset()
+
+
 class Shape(Component):
+    __slots__ = ("ignored_entities", "shape", "shape_size", "on_collide", "color", "texture", "layer", "mask",
+                 "_cached_x", "_cached_y", "_cached_scale", "_world_shape", "_bounds")
+
     def __init__(self, shape, shape_size, color):
         super().__init__(ComponentType.Shape_)
-        self.ignored_entities = set()
+        self.ignored_entities = _NO_IGNORED_ENTITIES
         self.shape = shape
         self.shape_size = shape_size
         self.on_collide = _default_on_collide
         self.color = color
         self.texture = None
+        self.layer = CollisionLayer.Default_
+        self.mask = CollisionLayer.All_
+        # entity position and scale the cached world shape and bounds were built from
+        self._cached_x = None
+        self._cached_y = None
+        self._cached_scale = None
+        self._world_shape = None
+        self._bounds = None
 
     def ignore(self, entity):
+        if self.ignored_entities is _NO_IGNORED_ENTITIES:
+            self.ignored_entities = set()
         self.ignored_entities.add(entity.id)
 
+    def accepts(self, other):
+        return self.mask & other.layer
+
+    def world_shape(self):
+        # (x, y, radius) for circles, (x, y, width, height) for boxes, in world space.
+        # Only rebuilt when the entity's position or scale differ from last time, so resting shapes allocate nothing.
+        # Kept as floats like batch_narrowphase's arrays: ints past 256 are a new object for every sum and square
+        # in the overlap tests, floats reuse the ones the last test freed
+        position = self.entity.position
+        scale = self.entity.scale
+        if position[0] != self._cached_x or position[1] != self._cached_y or scale != self._cached_scale:
+            self._cached_x = position[0]
+            self._cached_y = position[1]
+            self._cached_scale = scale
+            x = float(position[0])
+            y = float(position[1])
+            scale = float(scale)
+            if self.shape == ShapeType.Circle_:
+                radius = scale * self.shape_size[0]
+                self._world_shape = (x, y, radius)
+                self._bounds = (x - radius, y - radius, x + radius, y + radius)
+            else:
+                width = scale * self.shape_size[0]
+                height = scale * self.shape_size[1]
+                self._world_shape = (x, y, width, height)
+                self._bounds = (x - width / 2, y - height / 2, x + width / 2, y + height / 2)
+        return self._world_shape
+
     def colliding_with(self, other):
+        # calls on_collide and returns True when the shapes overlap
         if other.entity.id in self.ignored_entities:
-            return
+            return False
+        shape_a = self.world_shape()
+        shape_b = other.world_shape()
         if self.shape == ShapeType.Circle_:
-            if other.shape == ShapeType.Circle_ and circle_circle_(
-                    (self.entity.position[0], self.entity.position[1], self.entity.scale * self.shape_size[0]),
-                    (other.entity.position[0], other.entity.position[1], other.entity.scale * other.shape_size[0])):
+            if other.shape == ShapeType.Circle_ and circle_circle_(shape_a, shape_b):
                 self.on_collide(self.entity, other.entity)
-            elif other.shape == ShapeType.Box_ and circle_box(
-                    (self.entity.position[0], self.entity.position[1], self.entity.scale * self.shape_size[0]), (
-                            other.entity.position[0], other.entity.position[1],
-                            other.entity.scale * other.shape_size[0],
-                            other.entity.scale * other.shape_size[1])):
+                return True
+            elif other.shape == ShapeType.Box_ and circle_box(shape_a, shape_b):
                 self.on_collide(self.entity, other.entity)
+                return True
         elif self.shape == ShapeType.Box_:
-            if other.shape == ShapeType.Circle_ and circle_box(
-                    (other.entity.position[0], other.entity.position[1], other.entity.scale * other.shape_size[0]), (
-                            self.entity.position[0], self.entity.position[1], self.entity.scale * self.shape_size[0],
-                            self.entity.scale * self.shape_size[1])):
+            if other.shape == ShapeType.Circle_ and circle_box(shape_b, shape_a):
                 self.on_collide(self.entity, other.entity)
-            elif other.shape == ShapeType.Box_ and box_in_box((
-                    self.entity.position[0], self.entity.position[1], self.entity.scale * self.shape_size[0],
-                    self.entity.scale * self.shape_size[1]), (
-                    other.entity.position[0], other.entity.position[1], other.entity.scale * other.shape_size[0],
-                    other.entity.scale * other.shape_size[1])):
+                return True
+            elif other.shape == ShapeType.Box_ and box_in_box(shape_a, shape_b):
                 self.on_collide(self.entity, other.entity)
+                return True
+        return False
 
     def draw(self, game):
         if self.texture is None:
@@ -110,10 +177,241 @@ class Shape(Component):
                 game.draw_box(self.entity.position[0], self.entity.position[1], self.entity.scale * self.shape_size[0],
                               self.entity.scale * self.shape_size[1], self.color, True)
         else:
-            game.draw_texture(self.entity.position[0], self.entity.position[1], self.texture, True)
+            game.draw_texture(self.entity.position[0], self.entity.position[1], self.texture_surface(), True)
+
+    def texture_surface(self):
+        # texture is either a Surface or the name of an asset that ASSETS loads on first use
+        if isinstance(self.texture, str):
+            return ASSETS.get(self.texture)
+        return self.texture
+
+    def bounds(self):
+        # world-space AABB as (min_x, min_y, max_x, max_y), boxes are centered like in circle_box and draw
+        self.world_shape()
+        return self._bounds
+
+    def draw_rect(self):
+        # area of the frame touched by draw
+        if self.texture is not None:
+            width, height = self.texture_surface().get_size()
+            return pygame.Rect(int(self.entity.position[0]) - width // 2, int(self.entity.position[1]) - height // 2,
+                               width + 1, height + 1)
+        min_x, min_y, max_x, max_y = self.bounds()
+        return pygame.Rect(int(min_x) - 1, int(min_y) - 1, int(max_x - min_x) + 3, int(max_y - min_y) + 3)
+
+
+# Broadphase
+# Produces the ordered pairs of shapes that Game.update hands to Shape.colliding_with (the narrowphase).
+# A World hands static shapes over once with add_static and drops them with remove, each tick
+# pairs only gets the world's moving entities. empty() gives a new broadphase set up the same way
+def collidable_shape(entity):
+    # shapes on no layer that react to nothing can't be in any pair
+    shape = entity.components.get(ComponentType.Shape_)
+    if shape is None or not shape.layer | shape.mask:
+        return None
+    return shape
+
+
+class BruteForceBroadphase:
+    def __init__(self):
+        self.statics = {}
+
+    def empty(self):
+        return BruteForceBroadphase()
+
+    def add_static(self, shape):
+        self.statics[shape.entity.id] = shape
+
+    def remove(self, entity):
+        self.statics.pop(entity.id, None)
+
+    def clear(self):
+        self.statics.clear()
+
+    def pairs(self, entities):
+        # group by (layer, mask) so groups that can't interact are skipped without visiting their pairs
+        groups = {}
+        for shape in itertools.chain(self.statics.values(), map(collidable_shape, entities)):
+            if shape is not None:
+                groups.setdefault((shape.layer, shape.mask), []).append(shape)
+        for (_, mask_a), shapes_a in groups.items():
+            for (layer_b, _), shapes_b in groups.items():
+                if not mask_a & layer_b:
+                    continue
+                for shape_a in shapes_a:
+                    for shape_b in shapes_b:
+                        if shape_a.entity.id != shape_b.entity.id:
+                            yield shape_a, shape_b
+
+    def resting(self):
+        # every pair gets tested every tick, so nothing is carried over
+        return ()
+
+    def touching(self, shape_a, shape_b):
+        pass
+
+
+class SpatialHashBroadphase:
+    # Shapes stay hashed between ticks. Static shapes are hashed once when they're added, moving ones are
+    # only rehashed when they're awake (new, moved or rescaled since last tick) and only awake shapes get
+    # paired, so the work follows the moving shapes rather than the entity count. Pairs that overlapped
+    # last tick while both shapes slept are handed back by resting() to collide again without a test
+    def __init__(self, cell_size):
+        self.cell_size = cell_size
+        self.cells = {}
+        # entity id -> [shape, cells it's in] for static shapes
+        self.statics = {}
+        # static shapes added since the last tick, paired once against what's already there
+        self.new_statics = {}
+        # entity id -> [shape, x, y, scale, cells it's in] for moving shapes
+        self.placed = {}
+        # (id a, id b) -> (shape_a, shape_b) for the ordered pairs that collided last tick
+        self.contacts = {}
+
+    def empty(self):
+        return SpatialHashBroadphase(self.cell_size)
+
+    def cell_keys(self, shape):
+        min_x, min_y, max_x, max_y = shape.bounds()
+        return [(cell_x, cell_y)
+                for cell_y in range(int(min_y // self.cell_size), int(max_y // self.cell_size) + 1)
+                for cell_x in range(int(min_x // self.cell_size), int(max_x // self.cell_size) + 1)]
+
+    def place(self, shape):
+        keys = self.cell_keys(shape)
+        for key in keys:
+            cell = self.cells.get(key)
+            if cell is None:
+                self.cells[key] = [shape]
+            else:
+                cell.append(shape)
+        return keys
+
+    def unplace(self, shape, keys):
+        for key in keys:
+            cell = self.cells[key]
+            cell.remove(shape)
+            if not cell:
+                del self.cells[key]
+
+    def add_static(self, shape):
+        self.statics[shape.entity.id] = [shape, self.place(shape)]
+        self.new_statics[shape.entity.id] = shape
+
+    def remove(self, entity):
+        record = self.statics.pop(entity.id, None) or self.placed.pop(entity.id, None)
+        if record is not None:
+            self.unplace(record[0], record[-1])
+        self.new_statics.pop(entity.id, None)
+
+    def clear(self):
+        self.cells.clear()
+        self.statics.clear()
+        self.new_statics.clear()
+        self.placed.clear()
+        self.contacts.clear()
+
+    def pairs(self, entities):
+        placed = self.placed
+        awake = self.new_statics
+        self.new_statics = {}
+        for entity in entities:
+            shape = collidable_shape(entity)
+            if shape is None:
+                continue
+            x, y = entity.position[0], entity.position[1]
+            scale = entity.scale
+            record = placed.get(entity.id)
+            if record is not None:
+                if record[0] is shape and record[1] == x and record[2] == y and record[3] == scale:
+                    continue
+                self.unplace(record[0], record[4])
+            placed[entity.id] = [shape, x, y, scale, self.place(shape)]
+            awake[entity.id] = shape
+        # contacts only survive while both shapes sleep and are still there
+        statics = self.statics
+        self.contacts = {key: pair for key, pair in self.contacts.items()
+                         if key[0] not in awake and key[1] not in awake
+                         and (key[0] in placed or key[0] in statics) and (key[1] in placed or key[1] in statics)}
+        seen_pairs = set()
+        for eid, shape_a in awake.items():
+            record = placed.get(eid) or statics[eid]
+            for key in record[-1]:
+                for shape_b in self.cells[key]:
+                    other = shape_b.entity.id
+                    if other == eid:
+                        continue
+                    # two awake shapes meet from both sides, keep the first
+                    if other in awake:
+                        pair_key = (eid, other) if eid < other else (other, eid)
+                        if pair_key in seen_pairs:
+                            continue
+                        seen_pairs.add(pair_key)
+                    elif (eid, other) in seen_pairs:
+                        continue
+                    else:
+                        seen_pairs.add((eid, other))
+                    if shape_a.accepts(shape_b):
+                        yield shape_a, shape_b
+                    if shape_b.accepts(shape_a):
+                        yield shape_b, shape_a
+
+    def resting(self):
+        return list(self.contacts.values())
+
+    def touching(self, shape_a, shape_b):
+        # records a pair the narrowphase found overlapping, it's resting next tick if neither moves
+        self.contacts[(shape_a.entity.id, shape_b.entity.id)] = (shape_a, shape_b)
+
+
+# Batch narrowphase
+# Same tests as circle_circle_, circle_box and box_in_box but over numpy arrays of candidate pairs
+def circle_box_batch(cx, cy, radius, bx, by, bw, bh):
+    closest_x = np.maximum(np.minimum(cx, bx + bw // 2), bx - bw // 2)
+    closest_y = np.maximum(np.minimum(cy, by + bh // 2), by - bh // 2)
+    return (cx - closest_x) ** 2 + (cy - closest_y) ** 2 <= radius ** 2
+
+
+def batch_narrowphase(pairs):
+    # returns the (shape_a, shape_b) pairs that collide, positions are read once before any on_collide runs
+    index = {}
+    shapes = []
+    pair_a = []
+    pair_b = []
+    for shape_a, shape_b in pairs:
+        if shape_b.entity.id in shape_a.ignored_entities:
+            continue
+        for shape, pair_index in ((shape_a, pair_a), (shape_b, pair_b)):
+            i = index.get(shape)
+            if i is None:
+                i = index[shape] = len(shapes)
+                shapes.append(shape)
+            pair_index.append(i)
+    if not pair_a:
+        return []
+    # per shape: x, y, width (radius for circles), height, is circle
+    params = np.array([(shape.entity.position[0], shape.entity.position[1],
+                        shape.entity.scale * shape.shape_size[0], shape.entity.scale * shape.shape_size[-1],
+                        shape.shape == ShapeType.Circle_) for shape in shapes], dtype=float)
+    ax, ay, aw, ah, a_circle = params[pair_a].T
+    bx, by, bw, bh, b_circle = params[pair_b].T
+    a_circle = a_circle.astype(bool)
+    b_circle = b_circle.astype(bool)
+    hits = np.zeros(len(pair_a), dtype=bool)
+    both_circles = a_circle & b_circle
+    hits[both_circles] = ((ax - bx) ** 2 + (ay - by) ** 2 <= (aw + bw) ** 2)[both_circles]
+    circle_vs_box = a_circle & ~b_circle
+    hits[circle_vs_box] = circle_box_batch(ax, ay, aw, bx, by, bw, bh)[circle_vs_box]
+    box_vs_circle = ~a_circle & b_circle
+    hits[box_vs_circle] = circle_box_batch(bx, by, bw, ax, ay, aw, ah)[box_vs_circle]
+    both_boxes = ~a_circle & ~b_circle
+    hits[both_boxes] = ((ax + aw >= bx) & (bx + bw >= ax) & (ay + ah >= bh) & (by + bh >= ay))[both_boxes]
+    return [(shapes[pair_a[i]], shapes[pair_b[i]]) for i in np.flatnonzero(hits)]
 
 
 class Controller(Component):
+    __slots__ = ("speed",)
+
     def __init__(self, speed):
         super().__init__(ComponentType.Controller_)
         self.speed = speed
@@ -130,6 +428,8 @@ class Controller(Component):
 
 
 class Label(Component):
+    __slots__ = ("txt", "color", "offset", "center", "size")
+
     def __init__(self, txt, offset, color, size: int = 20, center: bool = False):
         super().__init__(ComponentType.Label_)
         self.txt = txt
@@ -145,19 +445,281 @@ class Label(Component):
 
 
 class Drift(Component):
+    __slots__ = ("direction", "speed")
+
     def __init__(self, direction, speed: int = 1):
         super().__init__(ComponentType.Drift_)
         self.direction = direction
         self.speed = speed
 
     def update(self, game):
+        # entities in the EntityStore drift in one vectorized step instead
+        if self.entity.slot is not None:
+            return
         self.entity.position[0] += self.direction[0] * self.speed
         self.entity.position[1] += self.direction[1] * self.speed
 
 
+# Raw asset cache layout: header then RGBA pixels, the header's png mtime and size tell if it's stale
+ASSET_CACHE_HEADER = struct.Struct("<4sIIdQ")
+ASSET_CACHE_MAGIC = b"SFTX"
+
+
+class AssetManager:
+    # Loads textures on first use, keeps them decoded on disk as raw RGBA under cache_dir for faster startups
+    # and converts them to the display's pixel format once there is a display, so blits skip per pixel conversion.
+    def __init__(self, root, cache_dir=None):
+        self.root = root
+        self.cache_dir = cache_dir
+        self.surfaces = {}
+        self.display_ready = False
+
+    def get(self, name):
+        surface = self.surfaces.get(name)
+        if surface is None:
+            surface = self.load(name)
+            if self.display_ready:
+                surface = surface.convert_alpha()
+            self.surfaces[name] = surface
+        return surface
+
+    def load(self, name):
+        path = os.path.join(self.root, name)
+        if self.cache_dir is None:
+            return pygame.image.load(path)
+        stat = os.stat(path)
+        cache_path = os.path.join(self.cache_dir, name + ".raw")
+        try:
+            with open(cache_path, "rb") as f:
+                data = f.read()
+            magic, width, height, mtime, size = ASSET_CACHE_HEADER.unpack_from(data)
+            if magic == ASSET_CACHE_MAGIC and mtime == stat.st_mtime and size == stat.st_size:
+                return pygame.image.frombytes(data[ASSET_CACHE_HEADER.size:], (width, height), "RGBA")
+        except (OSError, struct.error):
+            pass
+        surface = pygame.image.load(path)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(cache_path, "wb") as f:
+                f.write(ASSET_CACHE_HEADER.pack(ASSET_CACHE_MAGIC, surface.get_width(), surface.get_height(),
+                                                stat.st_mtime, stat.st_size))
+                f.write(pygame.image.tobytes(surface, "RGBA"))
+        except OSError:
+            pass
+        return surface
+
+    def on_display_ready(self):
+        self.display_ready = True
+        for name, surface in self.surfaces.items():
+            self.surfaces[name] = surface.convert_alpha()
+
+
+ASSET_ROOT = os.path.dirname(os.path.abspath(__file__))
+ASSETS = AssetManager(ASSET_ROOT, os.path.join(ASSET_ROOT, ".asset_cache"))
+
+
 def load_texture(path):
-    full_path = os.path.dirname(os.path.abspath(__file__))
-    return pygame.image.load(full_path + "/" + path)
+    return ASSETS.get(path)
+
+
+class TextCache:
+    # Fonts are kept per size, rendered strings are kept in an LRU bounded by max_bytes of surface memory
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.used_bytes = 0
+        self.fonts = {}
+        self.surfaces = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get_font(self, size):
+        font = self.fonts.get(size)
+        if font is None:
+            font = pygame.font.Font(None, size)
+            self.fonts[size] = font
+        return font
+
+    def render(self, txt: str, size: int, color: pygame.Color):
+        key = (txt, size, tuple(color))
+        surface = self.surfaces.get(key)
+        if surface is not None:
+            self.hits += 1
+            self.surfaces.move_to_end(key)
+            return surface
+        self.misses += 1
+        surface = self.get_font(size).render(txt, True, color)
+        self.surfaces[key] = surface
+        self.used_bytes += surface_bytes(surface)
+        while self.used_bytes > self.max_bytes and len(self.surfaces) > 1:
+            _, evicted = self.surfaces.popitem(last=False)
+            self.used_bytes -= surface_bytes(evicted)
+        return surface
+
+    def clear(self):
+        self.surfaces.clear()
+        self.used_bytes = 0
+
+
+def surface_bytes(surface):
+    return surface.get_height() * surface.get_pitch()
+
+
+# Widest an atlas gets before textures wrap onto the next shelf
+ATLAS_WIDTH = 256
+
+
+class TextureAtlas:
+    # Copies textures side by side into one surface, so a SpriteBatch draws them all from a single source
+    def __init__(self, surfaces):
+        # shelf packing: tallest first, left to right, a new shelf whenever a row reaches ATLAS_WIDTH
+        self.regions = {}
+        placements = []
+        x = y = width = shelf_height = 0
+        for surface in sorted(dict.fromkeys(surfaces), key=lambda surface: surface.get_height(), reverse=True):
+            if x and x + surface.get_width() > ATLAS_WIDTH:
+                x = 0
+                y += shelf_height
+                shelf_height = 0
+            placements.append((surface, x, y))
+            x += surface.get_width()
+            width = max(width, x)
+            shelf_height = max(shelf_height, surface.get_height())
+        self.surface = pygame.Surface((max(width, 1), max(y + shelf_height, 1)), pygame.SRCALPHA)
+        for surface, x, y in placements:
+            # max against the transparent atlas copies the pixels as they are instead of alpha blending them
+            self.surface.blit(surface, (x, y), special_flags=pygame.BLEND_RGBA_MAX)
+            self.regions[surface] = pygame.Rect((x, y), surface.get_size())
+        if pygame.display.get_surface() is not None:
+            self.surface = self.surface.convert_alpha()
+
+    def find(self, surface):
+        # (source, area) to draw surface from, the atlas when it holds it
+        area = self.regions.get(surface)
+        if area is None:
+            return surface, None
+        return self.surface, area
+
+
+# Draw order inside a SpriteBatch, lower layers are drawn first
+class SpriteLayer:
+    Static_ = 0
+    Moving_ = 1
+    Text_ = 2
+
+
+def _sprite_layer(command):
+    return command[0]
+
+
+class SpriteBatch:
+    # Blits collected over a frame and submitted in one Surface.blits, sorted by layer (stable, so
+    # sprites on the same layer keep the order they were added in)
+    def __init__(self, atlas=None):
+        self.atlas = atlas
+        self.commands = []
+
+    def add(self, layer, surface, dest):
+        source, area = self.atlas.find(surface) if self.atlas is not None else (surface, None)
+        self.commands.append((layer, source, dest, area))
+
+    def flush(self, target):
+        # draws and forgets the commands, returns the rects they touched
+        if not self.commands:
+            return []
+        self.commands.sort(key=_sprite_layer)
+        rects = target.blits([command[1:] for command in self.commands])
+        self.commands.clear()
+        return rects
+
+
+COMPONENT_NAMES = {value: name.rstrip("_") for name, value in vars(ComponentType).items() if not name.startswith("__")}
+
+
+class FrameProfiler:
+    # Rolling per phase frame timings (seconds) plus per component type costs and collision pair counts.
+    # Every export_every frames the p50/p95/p99 of each metric is appended to export_path (.csv or json lines).
+    def __init__(self, export_path=None, window: int = 600, export_every: int = 600):
+        self.export_path = export_path
+        self.export_every = export_every
+        self.window = window
+        self.history = {}
+        self.current = {}
+        self.started = {}
+        self.frame_count = 0
+        self.show_hud = False
+        self.hud_lines = []
+        self.header_written = False
+
+    def start(self, phase):
+        self.started[phase] = time.perf_counter()
+
+    def stop(self, phase):
+        self.add(phase, time.perf_counter() - self.started[phase])
+
+    def add(self, metric, value):
+        self.current[metric] = self.current.get(metric, 0) + value
+
+    def update_components(self, entity, game):
+        for component in entity.components.values():
+            start = time.perf_counter()
+            component.update(game)
+            self.add("update." + COMPONENT_NAMES[component.component_type], time.perf_counter() - start)
+
+    def draw_components(self, entity, game):
+        for component in entity.components.values():
+            start = time.perf_counter()
+            component.draw(game)
+            self.add("draw." + COMPONENT_NAMES[component.component_type], time.perf_counter() - start)
+
+    def end_frame(self):
+        for metric, value in self.current.items():
+            samples = self.history.get(metric)
+            if samples is None:
+                samples = self.history[metric] = deque(maxlen=self.window)
+            samples.append(value)
+        self.current = {}
+        self.frame_count += 1
+        # the HUD text only changes a few times a second so the text cache isn't flooded
+        if self.show_hud and self.frame_count % 30 == 1:
+            self.hud_lines = self.format_hud()
+        if self.export_path is not None and self.frame_count % self.export_every == 0:
+            self.export()
+
+    def percentiles(self):
+        result = {}
+        for metric, samples in self.history.items():
+            ordered = sorted(samples)
+            last = len(ordered) - 1
+            result[metric] = (ordered[last * 50 // 100], ordered[last * 95 // 100], ordered[last * 99 // 100])
+        return result
+
+    def format_hud(self):
+        lines = []
+        for metric, (p50, p95, p99) in sorted(self.percentiles().items()):
+            if metric.startswith("pairs."):
+                lines.append("%s %d / %d / %d" % (metric, p50, p95, p99))
+            else:
+                lines.append("%s %.2f / %.2f / %.2f ms" % (metric, p50 * 1000, p95 * 1000, p99 * 1000))
+        return lines
+
+    def draw(self, game):
+        for i, line in enumerate(self.hud_lines):
+            game.draw_text(line, 4, 4 + i * 12, 16, pygame.Color(0xffff00ff))
+
+    def export(self):
+        stats = self.percentiles()
+        if self.export_path.endswith(".csv"):
+            with open(self.export_path, "a" if self.header_written else "w") as f:
+                if not self.header_written:
+                    f.write("frame,metric,p50,p95,p99\n")
+                for metric, (p50, p95, p99) in sorted(stats.items()):
+                    f.write("%d,%s,%r,%r,%r\n" % (self.frame_count, metric, p50, p95, p99))
+        else:
+            with open(self.export_path, "a" if self.header_written else "w") as f:
+                f.write(json.dumps({"frame": self.frame_count,
+                                    "metrics": {metric: {"p50": p50, "p95": p95, "p99": p99}
+                                                for metric, (p50, p95, p99) in stats.items()}}) + "\n")
+        self.header_written = True
 
 
 def create_display(width, height, title="pygame-display"):
@@ -167,38 +729,246 @@ def create_display(width, height, title="pygame-display"):
     return display, width, height
 
 
-TO_REMOVE = []
-ENTITIES = {}
+class EntityStore:
+    # Struct of arrays for positions, scales and drift velocities, one row per entity slot.
+    # Entities in the store see their row through numpy views, so entity.position keeps working.
+    def __init__(self, capacity: int = 256):
+        self.positions = np.zeros((capacity, 2))
+        self.scales = np.ones(capacity)
+        self.drifts = np.zeros((capacity, 2))
+        self.entities = [None] * capacity
+        self.free_slots = list(range(capacity - 1, -1, -1))
+
+    def grow(self):
+        capacity = len(self.entities)
+        self.positions = np.concatenate((self.positions, np.zeros((capacity, 2))))
+        self.scales = np.concatenate((self.scales, np.ones(capacity)))
+        self.drifts = np.concatenate((self.drifts, np.zeros((capacity, 2))))
+        self.entities.extend([None] * capacity)
+        self.free_slots.extend(range(capacity * 2 - 1, capacity - 1, -1))
+        # the old arrays are gone, point every entity at its row in the new ones
+        for slot, entity in enumerate(self.entities):
+            if entity is not None:
+                entity._position = self.positions[slot]
+
+    def add(self, entity):
+        if entity.slot is not None:
+            return
+        if not self.free_slots:
+            self.grow()
+        slot = self.free_slots.pop()
+        self.positions[slot] = entity.position
+        self.scales[slot] = entity.scale
+        self.entities[slot] = entity
+        entity._position = self.positions[slot]
+        entity.slot = slot
+        self.track_drift(entity)
+
+    def remove(self, entity):
+        slot = entity.slot
+        if slot is None:
+            return
+        # hand the entity its values back as plain python objects
+        entity._position = [float(self.positions[slot][0]), float(self.positions[slot][1])]
+        entity._scale = float(self.scales[slot])
+        entity.slot = None
+        self.drifts[slot] = 0
+        self.entities[slot] = None
+        self.free_slots.append(slot)
+
+    def track_drift(self, entity):
+        # velocity is read from the Drift component when it enters the store
+        drift = entity.components.get(ComponentType.Drift_)
+        if drift is None:
+            self.drifts[entity.slot] = 0
+        else:
+            self.drifts[entity.slot] = (drift.direction[0] * drift.speed, drift.direction[1] * drift.speed)
+
+    def step_drift(self):
+        self.positions += self.drifts
+
+
+# Candidate pair count from which Game.update switches to batch_narrowphase (requires numpy)
+BATCH_NARROWPHASE_MIN_PAIRS = 256
+# Build the next level on a background thread during play instead of inside the transition frame
+PRELOAD_LEVELS = True
+# Keeps positions, scales and drift in numpy arrays (requires numpy), off keeps them in per entity python objects
+USE_ENTITY_STORE = False
+_OVERRIDES = {}
 
 
-def add_entity(entity):
-    ENTITIES[entity.id] = entity
+def overrides(cls, base, method):
+    # True when cls replaces base's version of method, cached since it's asked for every entity added
+    key = (cls, method)
+    result = _OVERRIDES.get(key)
+    if result is None:
+        result = _OVERRIDES[key] = getattr(cls, method) is not getattr(base, method)
+    return result
+
+
+class ComponentRegistry:
+    # Components of the entities in the world grouped by ComponentType, so Game.update can run one system per type
+    # over only the components that do something in update, and render can skip entities with nothing to draw.
+    # Entities that override Entity.update keep being updated as a whole, their components stay out of the systems.
+    def __init__(self):
+        self.updating = {}
+        self.update_order = []
+        self.custom_updating = {}
+        self.drawing = {}
+
+    def add(self, entity):
+        if overrides(type(entity), Entity, "update"):
+            self.custom_updating[entity.id] = entity
+        if overrides(type(entity), Entity, "draw"):
+            self.drawing[entity.id] = entity
+        for component in entity.components.values():
+            self.add_component(entity, component)
+
+    def add_component(self, entity, component):
+        if entity.id not in self.custom_updating and overrides(type(component), Component, "update"):
+            group = self.updating.get(component.component_type)
+            if group is None:
+                group = self.updating[component.component_type] = {}
+                self.update_order = sorted(self.updating)
+            group[entity.id] = component
+        if overrides(type(component), Component, "draw"):
+            self.drawing[entity.id] = entity
+
+    def remove(self, entity):
+        self.custom_updating.pop(entity.id, None)
+        self.drawing.pop(entity.id, None)
+        for component in entity.components.values():
+            group = self.updating.get(component.component_type)
+            if group is not None:
+                group.pop(entity.id, None)
+
+    def clear(self):
+        for group in self.updating.values():
+            group.clear()
+        self.custom_updating.clear()
+        self.drawing.clear()
+
+
+def add_entity(entity, world=None):
+    (world if world is not None else WORLD).add(entity)
 
 
 def remove_entity(entity):
-    if entity.id in ENTITIES:
-        TO_REMOVE.append(entity.id)
+    if entity.world is not None:
+        entity.world.remove(entity)
+
+
+def clear_entities(world=None):
+    (world if world is not None else WORLD).clear()
+
+
+class EntityPool:
+    # Free lists of entities by class, so level changes reuse entities and their shapes instead of reallocating
+    # The lock lets LevelPreloader spawn on its worker thread while the game releases collected entities.
+    def __init__(self):
+        self.free = {}
+        self.lock = threading.Lock()
+
+    def spawn(self, cls, x, y):
+        with self.lock:
+            free = self.free.get(cls)
+            entity = free.pop() if free else None
+        if entity is None:
+            return cls(x, y)
+        entity.reset(x, y)
+        return entity
+
+    def release(self, entity):
+        if entity.poolable:
+            with self.lock:
+                self.free.setdefault(type(entity), []).append(entity)
+
+    def clear(self):
+        with self.lock:
+            self.free.clear()
+
+
+ENTITY_POOL = EntityPool()
+
+
+def spawn_entity(cls, x, y, world=None):
+    entity = ENTITY_POOL.spawn(cls, x, y)
+    add_entity(entity, world)
+    return entity
 
 
 class Entity:
-    _nextID = 0
+    __slots__ = ("world", "slot", "_position", "_scale", "static", "components", "id")
+    # itertools.count hands out ids safely from the level preloader thread too
+    _ids = itertools.count()
+    # poolable entities go back to ENTITY_POOL when they leave the world and get reused by spawn_entity
+    poolable = False
 
     def __init__(self):
+        # the World the entity is in and its row in that world's EntityStore, None while it's in no world
+        self.world = None
+        self.slot = None
         self.position = [0, 0]
         self.scale = 1
+        # static entities never move and get baked into Game.static_layer instead of drawn every frame
+        self.static = False
         self.components = {}
-        self.id = Entity._nextID
-        Entity._nextID += 1
+        self.id = next(Entity._ids)
+
+    @property
+    def position(self):
+        return self._position
+
+    @position.setter
+    def position(self, value):
+        # store backed entities write through to their row so the view stays attached
+        if self.slot is None:
+            self._position = value
+        else:
+            self._position[0] = value[0]
+            self._position[1] = value[1]
+
+    @property
+    def scale(self):
+        if self.slot is None:
+            return self._scale
+        return self.world.store.scales[self.slot]
+
+    @scale.setter
+    def scale(self, value):
+        if self.slot is None:
+            self._scale = value
+        else:
+            self.world.store.scales[self.slot] = value
+
+    def reset(self, x, y):
+        # puts a pooled entity back into its just constructed state at (x, y)
+        self.position = [x, y]
+        self.scale = 1
 
     def add_component(self, component):
         component.entity = self
         self.components[component.component_type] = component
+        if self.world is not None:
+            self.world.registry.add_component(self, component)
+            if self.static and component.component_type == ComponentType.Shape_:
+                self.world.broadphase.remove(self)
+                if collidable_shape(self) is not None:
+                    self.world.broadphase.add_static(component)
+        if self.slot is not None and component.component_type == ComponentType.Drift_:
+            self.world.store.track_drift(self)
 
     def update(self, game):
+        if game.profiler is not None:
+            game.profiler.update_components(self, game)
+            return
         for component in self.components.values():
             component.update(game)
 
     def draw(self, game):
+        if game.profiler is not None:
+            game.profiler.draw_components(self, game)
+            return
         for component in self.components.values():
             component.draw(game)
 
@@ -255,19 +1025,31 @@ class Entity:
 # Part 4
 WIDTH = 960
 HEIGHT = 960
-spark_tex = load_texture("charge.png")
-fly_tex = load_texture("fly.png")
-insulator_tex = load_texture("insulator.png")
-minus_tex = load_texture("minus.png")
-plus_tex = load_texture("plus.png")
+# asset names, the textures are only loaded the first time something draws them
+spark_tex = "charge.png"
+fly_tex = "fly.png"
+insulator_tex = "insulator.png"
+minus_tex = "minus.png"
+plus_tex = "plus.png"
+# shared by the map entities instead of a Color each
+WHITE = pygame.Color(0xffffffff)
+# Textures packed into the sprite batch's atlas
+ATLAS_TEXTURES = [spark_tex, fly_tex, insulator_tex, minus_tex, plus_tex]
+
+
+FLY_RADIUS = 4
 
 
 class Fly(Entity):
+    __slots__ = ("sparkCount", "deathCount", "start_position")
+
     def __init__(self, x: int, y: int):
         super().__init__()
         self.position = [x, y]
-        shape = Shape(ShapeType.Circle_, [4], pygame.Color(0xffffffff))
+        shape = Shape(ShapeType.Circle_, [FLY_RADIUS], pygame.Color(0xffffffff))
         shape.texture = fly_tex
+        shape.layer = CollisionLayer.Player_
+        shape.mask = CollisionLayer.Static_
         self.add_component(shape)
         self.add_component(Controller(3))
         self.add_component(Drift([0, 1]))
@@ -281,152 +1063,747 @@ class Fly(Entity):
                        pygame.Color(0xffffffff), True)
 
 
+def _spark_collide(entity_a, entity_b):
+    remove_entity(entity_a)
+    entity_b.sparkCount += 1
+
+
 class Spark(Entity):
+    __slots__ = ()
+    poolable = True
+
     def __init__(self, x: int, y: int):
         super().__init__()
         self.position = [x, y]
-        shape = Shape(ShapeType.Circle_, [8], pygame.Color(0xffffffff))
+        self.static = True
+        shape = Shape(ShapeType.Circle_, (8,), WHITE)
 
-        def on_collide(entity_a, entity_b):
-            remove_entity(entity_a)
-            entity_b.sparkCount += 1
-
-        shape.on_collide = on_collide
+        shape.on_collide = _spark_collide
         shape.texture = spark_tex
+        shape.layer = CollisionLayer.Static_
+        shape.mask = CollisionLayer.Player_
         self.add_component(shape)
 
 
-class Insulator(Entity):
-    def __init__(self, x: int, y: int):
-        super().__init__()
-        self.position = [x, y]
-        shape = Shape(ShapeType.Box_, [16, 16], pygame.Color(0xffffffff))
+def _insulator_collide(fly):
+    fly.position = fly.start_position.copy()
+    fly.deathCount += 1
+
+
+# Tile codes of the uint8 grids gen_map makes and level files store
+TILE_EMPTY = 0
+TILE_INSULATOR = 1
+TILE_SPARK = 2
+TILE_MINUS = 3
+TILE_PLUS = 4
+TILE_FLY = 5
+
+
+class TileMap:
+    # gen_map's grid, one byte per tile, of which only the insulator walls matter here. Collisions only look
+    # at the tiles under a shape and runs holds the walls merged into as few rects as possible for drawing
+    def __init__(self, width, height, tile_size, tiles=None):
+        self.width = width
+        self.height = height
+        self.tile_size = tile_size
+        self.tiles = tiles if tiles is not None else bytearray(width * height)
+        self.runs = []
+
+    def circle_hits(self, x, y, radius):
+        size = self.tile_size
+        for row in range(max(0, int((y - radius) // size)), min(self.height, int((y + radius) // size) + 1)):
+            for column in range(max(0, int((x - radius) // size)), min(self.width, int((x + radius) // size) + 1)):
+                if self.tiles[column + row * self.width] == TILE_INSULATOR and circle_box(
+                        (x, y, radius), (column * size + size // 2, row * size + size // 2, size, size)):
+                    return True
+        return False
+
+    def merge_runs(self):
+        # horizontal runs of wall tiles, grown downwards while the next row repeats the exact same run
+        size = self.tile_size
+        self.runs = []
+        open_runs = {}
+        for row in range(self.height):
+            row_runs = {}
+            column = 0
+            while column < self.width:
+                if self.tiles[column + row * self.width] != TILE_INSULATOR:
+                    column += 1
+                    continue
+                start = column
+                while column < self.width and self.tiles[column + row * self.width] == TILE_INSULATOR:
+                    column += 1
+                rect = open_runs.get((start, column))
+                if rect is None:
+                    rect = pygame.Rect(start * size, row * size, (column - start) * size, size)
+                    self.runs.append(rect)
+                else:
+                    rect.height += size
+                row_runs[(start, column)] = rect
+            open_runs = row_runs
 
-        def on_collide(entity_a, entity_b):
-            entity_b.position = entity_b.start_position.copy()
-            entity_b.deathCount += 1
+    def runs_in(self, rect):
+        return [self.runs[i] for i in rect.collidelistall(self.runs)]
 
-        shape.on_collide = on_collide
-        shape.texture = insulator_tex
-        self.add_component(shape)
+
+# Charges push or pull the fly while it's within CHARGE_RADIUS of them, through the level's ChargeField
+CHARGE_RADIUS = 48
+
+
+def _minus_force(n_x, n_y):
+    return 0.1 * n_x * n_x, 0.1 * n_y * n_y
 
 
 class Minus(Entity):
+    __slots__ = ()
+    poolable = True
+    force = staticmethod(_minus_force)
+
     def __init__(self, x: int, y: int):
         super().__init__()
         self.position = [x, y]
-        shape = Shape(ShapeType.Circle_, [48], pygame.Color(0xffffffff))
-
-        def on_collide(entity_a, entity_b):
-            away = [entity_b.position[0] - entity_a.position[0], entity_b.position[1] - entity_a.position[1]]
-            D = (away[0] ** 2 + away[1] ** 2) ** .5
-            n_x = away[0] / D
-            n_y = away[1] / D
-            entity_b.position[0] += 0.1 * n_x * n_x
-            entity_b.position[1] += 0.1 * n_y * n_y
+        self.static = True
+        shape = Shape(ShapeType.Circle_, (CHARGE_RADIUS,), WHITE)
 
-        shape.on_collide = on_collide
         shape.texture = minus_tex
+        shape.layer = CollisionLayer.None_
+        shape.mask = CollisionLayer.None_
         self.add_component(shape)
 
 
+def _plus_force(n_x, n_y):
+    return -0.5 * n_x, -0.5 * n_y
+
+
 class Plus(Entity):
+    __slots__ = ()
+    poolable = True
+    force = staticmethod(_plus_force)
+
     def __init__(self, x: int, y: int):
         super().__init__()
         self.position = [x, y]
-        shape = Shape(ShapeType.Circle_, [48], pygame.Color(0xffffffff))
+        self.static = True
+        shape = Shape(ShapeType.Circle_, (CHARGE_RADIUS,), WHITE)
 
-        def on_collide(entity_a, entity_b):
-            away = [entity_b.position[0] - entity_a.position[0], entity_b.position[1] - entity_a.position[1]]
-            D = (away[0] ** 2 + away[1] ** 2) ** .5
-            entity_b.position[0] -= 0.5 * away[0] / D
-            entity_b.position[1] -= 0.5 * away[1] / D
-
-        shape.on_collide = on_collide
         shape.texture = plus_tex
+        shape.layer = CollisionLayer.None_
+        shape.mask = CollisionLayer.None_
         self.add_component(shape)
 
 
-TILE_SIZE = 16
+class ChargeField:
+    # Every charge's push/pull summed per cell when the level is built,
+    # so moving the fly costs one lookup a tick however many charges there are
+    def __init__(self, width, height, cell_size):
+        self.cell_size = cell_size
+        self.columns = -(-width // cell_size)
+        self.rows = -(-height // cell_size)
+        if np is not None:
+            self.force_x = np.zeros(self.columns * self.rows)
+            self.force_y = np.zeros(self.columns * self.rows)
+        else:
+            self.force_x = [0.0] * (self.columns * self.rows)
+            self.force_y = [0.0] * (self.columns * self.rows)
+
+    def add_charge(self, x, y, reach, force):
+        # force(n_x, n_y) is the charge's effect on something in the direction n from it, sampled at cell centres
+        size = self.cell_size
+        first_row, end_row = max(0, int((y - reach) // size)), min(self.rows, int((y + reach) // size) + 1)
+        first_column, end_column = max(0, int((x - reach) // size)), min(self.columns, int((x + reach) // size) + 1)
+        if np is not None:
+            # the whole square around the charge at once, force only does arithmetic so it takes arrays too
+            away_x = (np.arange(first_column, end_column) * size + size / 2 - x)[None, :]
+            away_y = (np.arange(first_row, end_row) * size + size / 2 - y)[:, None]
+            D = np.sqrt(away_x ** 2 + away_y ** 2)
+            inside = (D > 0) & (D <= reach)
+            D[~inside] = 1
+            f_x, f_y = force(away_x / D, away_y / D)
+            window = np.s_[first_row:end_row, first_column:end_column]
+            self.force_x.reshape(self.rows, self.columns)[window] += np.where(inside, f_x, 0)
+            self.force_y.reshape(self.rows, self.columns)[window] += np.where(inside, f_y, 0)
+            return
+        for row in range(first_row, end_row):
+            away_y = row * size + size / 2 - y
+            for column in range(first_column, end_column):
+                away_x = column * size + size / 2 - x
+                D = (away_x ** 2 + away_y ** 2) ** .5
+                if D == 0 or D > reach:
+                    continue
+                f_x, f_y = force(away_x / D, away_y / D)
+                self.force_x[column + row * self.columns] += f_x
+                self.force_y[column + row * self.columns] += f_y
+
+    def apply(self, entity):
+        column = int(entity.position[0] // self.cell_size)
+        row = int(entity.position[1] // self.cell_size)
+        if 0 <= column < self.columns and 0 <= row < self.rows:
+            entity.position[0] += float(self.force_x[column + row * self.columns])
+            entity.position[1] += float(self.force_y[column + row * self.columns])
 
 
-def gen_map(width, height):
-    map = [0 for i in range(width * height)]
-    player_x, player_y = random.randint(1, width - 2), random.randint(1, height - 2)
+TILE_SIZE = 16
+# Set to False to fall back to testing every pair of entities, handy for A/B comparisons
+USE_SPATIAL_HASH = True
+# Set to False to draw static entities one by one every frame
+USE_STATIC_LAYER = True
+# Biggest map, in pixels, that still gets a static layer, past that static entities are drawn culled to the view
+STATIC_LAYER_MAX_PIXELS = 4096 * 4096
+# Memory budget for rendered text kept by Game.draw_text
+TEXT_CACHE_BYTES = 1024 * 1024
+# Simulation ticks per second, independent of how fast frames are rendered
+TICK_RATE = 60
+# Max rendered frames per second, 0 leaves it uncapped
+FRAME_RATE_CAP = 120
+# Longest frame the accumulator will catch up on, avoids spiralling after a stall
+MAX_FRAME_TIME = 0.25
+# Size of a frame pixel in window pixels, 1 renders straight into the window with no scaling
+PIXEL_SCALE = 2
+# Resolution of the precomputed charge forces, finer follows the charge radius more closely but builds slower
+CHARGE_FIELD_CELL = TILE_SIZE // 2
+# Present only the regions that changed since the last frame instead of the whole window
+USE_DIRTY_RECTS = True
+# Set to False to blit every texture the moment it's drawn instead of once per frame from an atlas
+USE_SPRITE_BATCH = True
+# Frame profiler, also enabled by running with --profile, F3 toggles its overlay
+USE_PROFILER = False
+PROFILER_EXPORT_PATH = "profile.csv"
+
+
+# Chance of an inner tile being an insulator, else a spark, else a charge (half minus, half plus)
+WALL_CHANCE = 0.05
+SPARK_CHANCE = 0.025
+CHARGE_CHANCE = 0.05
+# Where generated levels are saved by seed and size and memory-mapped back next time, None always generates
+LEVEL_CACHE_DIR = None
+
+
+# gen_map's rolls are splitmix64 of the seed and a counter, so numpy and plain Python draw the same numbers.
+# Stored in level files and input logs, bump it whenever the same seed would give a different map
+MAP_GENERATOR = 1
+MASK_64 = 2 ** 64 - 1
+
+
+def map_roll(seed, counter):
+    # the counter-th roll of seed, a float in [0, 1)
+    z = ((seed & MASK_64) + (counter + 1) * 0x9E3779B97F4A7C15) & MASK_64
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & MASK_64
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & MASK_64
+    return ((z ^ (z >> 31)) >> 11) * 2.0 ** -53
+
+
+def map_rolls(seed, start, count):
+    # map_roll for count counters from start at once, uint64 arithmetic wraps just like the masks above
+    z = np.arange(start + 1, start + count + 1, dtype=np.uint64) * np.uint64(0x9E3779B97F4A7C15) \
+        + np.uint64(seed & MASK_64)
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return ((z ^ (z >> np.uint64(31))) >> np.uint64(11)) * 2.0 ** -53
+
+
+def gen_map(width, height, seed):
+    # the same seed and size always give the same map, returned as a bytearray of tile codes row by row.
+    # Rolls 0 and 1 place the player, then each tile gets four: wall, spark, charge and the charge's sign.
+    # numpy classifies every tile at once, without it the tiles are classified one by one from the same rolls
+    player_x = 1 + int(map_roll(seed, 0) * (width - 2))
+    player_y = 1 + int(map_roll(seed, 1) * (height - 2))
+    area = width * height
+    if np is not None:
+        rolls = map_rolls(seed, 2, 4 * area).reshape(4, height, width)
+        charges = np.where(rolls[3] < 0.5, TILE_MINUS, TILE_PLUS)
+        grid = np.where(rolls[0] < WALL_CHANCE, TILE_INSULATOR, np.where(
+            rolls[1] < SPARK_CHANCE, TILE_SPARK, np.where(rolls[2] < CHARGE_CHANCE, charges, TILE_EMPTY)))
+        grid = grid.astype(np.uint8)
+        grid[0, :] = grid[-1, :] = grid[:, 0] = grid[:, -1] = TILE_INSULATOR
+        grid[player_y, player_x] = TILE_FLY
+        return bytearray(grid.tobytes())
+    map = bytearray(area)
     for i in range(0, height):
         for j in range(0, width):
-            if i == 0 or j == 0 or i == height - 1 or j == width - 1:
-                map[j + i * width] = "I"
-            elif random.random() < 0.05:
-                x_width = random.randint(1, 7)
-                y_height = 1 if x_width != 1 else random.randint(2, 7)
-                for u in range(i, min(i + y_height, height)):
-                    for v in range(j, min(j + x_width, width)):
-                        map[v + u * width] = "I"
-            elif random.random() < 0.025:
-                map[j + i * width] = "S"
-            elif random.random() < 0.05:
-                if random.random() < 0.5:
-                    map[j + i * width] = "M"
-                else:
-                    map[j + i * width] = "P"
-            else:
-                map[j + i * width] = "B"
-    map[player_x + player_y * width] = "F"
+            tile = 2 + j + i * width
+            if i == 0 or j == 0 or i == height - 1 or j == width - 1 or map_roll(seed, tile) < WALL_CHANCE:
+                map[j + i * width] = TILE_INSULATOR
+            elif map_roll(seed, tile + area) < SPARK_CHANCE:
+                map[j + i * width] = TILE_SPARK
+            elif map_roll(seed, tile + 2 * area) < CHARGE_CHANCE:
+                map[j + i * width] = TILE_MINUS if map_roll(seed, tile + 3 * area) < 0.5 else TILE_PLUS
+    map[player_x + player_y * width] = TILE_FLY
     return map
 
 
-HALF_WIDTH = WIDTH // 2
-HALF_HEIGHT = WIDTH // 2
-MAP_WIDTH = HALF_WIDTH // TILE_SIZE
-MAP_HEIGHT = HALF_HEIGHT // TILE_SIZE
-
-
-class SparkCounter:
-    count = 0
-
+# Level file layout, all little endian:
+# header "SFLV", version u8, MAP_GENERATOR u8, width u32, height u32, seed u64,
+# then width * height tile bytes row by row
+LEVEL_FILE_MAGIC = b"SFLV"
+LEVEL_FILE_VERSION = 2
+LEVEL_FILE_HEADER = struct.Struct("<4sBBIIQ")
+
+
+def save_level(path, width, height, seed, tiles):
+    # written next to path and renamed over it, so a reader never maps a half written file
+    temp_path = "%s.%d.tmp" % (path, os.getpid())
+    with open(temp_path, "wb") as f:
+        f.write(LEVEL_FILE_HEADER.pack(LEVEL_FILE_MAGIC, LEVEL_FILE_VERSION, MAP_GENERATOR, width, height, seed))
+        f.write(tiles)
+    os.replace(temp_path, path)
+
+
+def load_level(path):
+    # returns (width, height, seed, tiles), the tiles are a read-only view straight into the mapped file
+    with open(path, "rb") as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if len(data) < LEVEL_FILE_HEADER.size:
+        raise ValueError("%s is truncated" % path)
+    magic, version, generator, width, height, seed = LEVEL_FILE_HEADER.unpack_from(data)
+    if magic != LEVEL_FILE_MAGIC or version != LEVEL_FILE_VERSION:
+        raise ValueError("%s is not a version %d level file" % (path, LEVEL_FILE_VERSION))
+    # its seed would make a different map here than the tiles it holds
+    if generator != MAP_GENERATOR:
+        raise ValueError("%s was generated by map generator %d, this is %d" % (path, generator, MAP_GENERATOR))
+    if len(data) < LEVEL_FILE_HEADER.size + width * height:
+        raise ValueError("%s is truncated" % path)
+    return width, height, seed, memoryview(data)[LEVEL_FILE_HEADER.size:LEVEL_FILE_HEADER.size + width * height]
+
+
+def level_tiles(width, height, seed):
+    # gen_map through LEVEL_CACHE_DIR when it's set
+    if LEVEL_CACHE_DIR is None:
+        return gen_map(width, height, seed)
+    path = os.path.join(LEVEL_CACHE_DIR, "%dx%d-%d.level" % (width, height, seed))
+    if os.path.exists(path):
+        try:
+            return load_level(path)[3]
+        except ValueError:
+            # left by an older version or another map generator, generated again below
+            pass
+    tiles = gen_map(width, height, seed)
+    os.makedirs(LEVEL_CACHE_DIR, exist_ok=True)
+    save_level(path, width, height, seed, tiles)
+    return tiles
+
+
+def tile_indices(tiles, tile):
+    # indices of every tile with that code, row by row
+    if np is not None:
+        return np.flatnonzero(np.frombuffer(tiles, dtype=np.uint8) == tile).tolist()
+    return [i for i, code in enumerate(tiles) if code == tile]
 
-class LevelCounter:
-    count = 0
 
+HALF_WIDTH = WIDTH // 2
+HALF_HEIGHT = WIDTH // 2
+# Maps bigger than the window scroll with the Camera, also set by running with --map-scale N
+MAP_SCALE = 1
+MAP_WIDTH = HALF_WIDTH // TILE_SIZE * MAP_SCALE
+MAP_HEIGHT = HALF_HEIGHT // TILE_SIZE * MAP_SCALE
+
+
+class Level:
+    # a generated level whose entities aren't in the world yet
+    def __init__(self, entities, fly_pos, spark_count, field, tiles, seed):
+        self.entities = entities
+        self.fly_pos = fly_pos
+        self.spark_count = spark_count
+        self.field = field
+        self.tiles = tiles
+        self.seed = seed
+        # set by stage
+        self.staged = None
+        self.static_index = None
+
+    def stage(self, world, static_index=None):
+        # adds the entities to world, an empty one from World.staging, and indexes the static ones for drawing,
+        # so that installing the level doesn't have to. Runs on LevelPreloader's thread
+        for entity in self.entities:
+            world.add(entity)
+        if static_index is not None:
+            static_index.build(entity for entity in world.registry.drawing.values() if entity.static)
+        self.staged = world
+        self.static_index = static_index
+
+
+def build_level(seed=None, path=None):
+    # touches no world state, so it can run on LevelPreloader's thread.
+    # Loads the level file at path, or else generates the level for seed, drawn from random when None
+    if path is not None:
+        width, height, seed, tiles = load_level(path)
+    else:
+        if seed is None:
+            seed = random.getrandbits(63)
+        width, height = MAP_WIDTH, MAP_HEIGHT
+        tiles = level_tiles(width, height, seed)
+    entities = []
+    for entity_type, tile in ((Spark, TILE_SPARK), (Minus, TILE_MINUS), (Plus, TILE_PLUS)):
+        for i in tile_indices(tiles, tile):
+            entities.append(ENTITY_POOL.spawn(entity_type, i % width * TILE_SIZE + TILE_SIZE // 2,
+                                              i // width * TILE_SIZE + TILE_SIZE // 2))
+    spark_count = sum(1 for entity in entities if isinstance(entity, Spark))
+    fly_pos = [0, 0]
+    for i in tile_indices(tiles, TILE_FLY):
+        fly_pos = [i % width * TILE_SIZE + TILE_SIZE // 2, i // width * TILE_SIZE + TILE_SIZE // 2]
+    field = ChargeField(width * TILE_SIZE, height * TILE_SIZE, CHARGE_FIELD_CELL)
+    for entity in entities:
+        if isinstance(entity, (Minus, Plus)):
+            # a charge touches the fly once their circles overlap
+            field.add_charge(entity.position[0], entity.position[1], CHARGE_RADIUS + FLY_RADIUS, entity.force)
+    tile_map = TileMap(width, height, TILE_SIZE, tiles)
+    tile_map.merge_runs()
+    return Level(entities, fly_pos, spark_count, field, tile_map, seed)
+
+
+class World:
+    # Everything a running game mutates: the entities and their bookkeeping, the fly and the level counters.
+    # Worlds are independent, so one process can hold several (see batch_sim.py).
+    def __init__(self):
+        self.entities = {}
+        self.to_remove = []
+        self.registry = ComponentRegistry()
+        self.store = EntityStore() if USE_ENTITY_STORE and np is not None else None
+        self.fly = Fly(0, 0)
+        self.spark_count = 0
+        self.level_count = 0
+        self.field = None
+        self.tiles = None
+        # entities that aren't static, the only ones collisions and interpolation look at every tick
+        self.moving = {}
+        # static shapes are handed over once here, static entities mustn't move or rescale while in the world
+        self.broadphase = SpatialHashBroadphase(TILE_SIZE) if USE_SPATIAL_HASH else BruteForceBroadphase()
+
+    def add(self, entity):
+        self.entities[entity.id] = entity
+        entity.world = self
+        self.registry.add(entity)
+        if self.store is not None:
+            self.store.add(entity)
+        if not entity.static:
+            self.moving[entity.id] = entity
+        else:
+            shape = collidable_shape(entity)
+            if shape is not None:
+                self.broadphase.add_static(shape)
+
+    def remove(self, entity):
+        # removal is deferred to sweep so callbacks can remove entities mid collision pass
+        if entity.id in self.entities:
+            self.to_remove.append(entity.id)
+
+    def detach(self, entity):
+        if self.store is not None:
+            self.store.remove(entity)
+        self.broadphase.remove(entity)
+        self.moving.pop(entity.id, None)
+        entity.world = None
+
+    def sweep(self):
+        # takes out everything remove() was called on and returns it
+        removed = []
+        for eid in self.to_remove:
+            entity = self.entities.pop(eid)
+            self.registry.remove(entity)
+            self.detach(entity)
+            removed.append(entity)
+        self.to_remove.clear()
+        return removed
 
-fly = Fly(0, 0)
-
+    def clear(self):
+        for entity in self.entities.values():
+            self.detach(entity)
+            ENTITY_POOL.release(entity)
+        self.entities.clear()
+        self.to_remove.clear()
+        self.registry.clear()
+        self.broadphase.clear()
+
+    def staging(self):
+        # an empty world set up like this one, for LevelPreloader to add the next level's entities to
+        staging = World()
+        staging.broadphase = self.broadphase.empty()
+        return staging
+
+    def retire_level(self):
+        # clear() without visiting every entity: the level's bookkeeping is dropped whole and its entities
+        # are returned, with their store, for release_entities to detach and pool later
+        self.detach(self.entities.pop(self.fly.id))
+        retired = (list(self.entities.values()), self.store)
+        self.entities.clear()
+        self.to_remove.clear()
+        self.moving.clear()
+        self.registry = ComponentRegistry()
+        self.broadphase = self.broadphase.empty()
+        if self.store is not None:
+            self.store = EntityStore()
+        return retired
+
+    def install_level(self, level):
+        self.spark_count = level.spark_count
+        self.field = level.field
+        self.tiles = level.tiles
+        staged = level.staged
+        if staged is None:
+            for entity in level.entities:
+                self.add(entity)
+        else:
+            # the entities are already in a world of their own (see Level.stage), this one takes over its
+            # bookkeeping instead of adding them one by one. update keeps ENTITIES pointing at self.entities
+            self.entities.update(staged.entities)
+            self.moving.update(staged.moving)
+            self.registry = staged.registry
+            self.broadphase = staged.broadphase
+            self.store = staged.store
+            for entity in level.entities:
+                entity.world = self
+        self.fly.position = level.fly_pos.copy()
+        self.fly.start_position = level.fly_pos.copy()
+        self.fly.sparkCount = 0
+        self.add(self.fly)
+
+
+# The world main.py plays in, the module level helpers below default to it
+WORLD = World()
+ENTITIES = WORLD.entities
+TO_REMOVE = WORLD.to_remove
+fly = WORLD.fly
+
+
+def release_entities(entities, store):
+    # the rest of World.clear for entities retire_level took out, safe on LevelPreloader's thread since
+    # nothing else holds them any more
+    for entity in entities:
+        if store is not None:
+            store.remove(entity)
+        entity.world = None
+        ENTITY_POOL.release(entity)
+
+
+def install_level(level, world=None):
+    (world if world is not None else WORLD).install_level(level)
+
+
+def create_world(world=None, path=None):
+    install_level(build_level(path=path), world)
+
+
+class LevelPreloader:
+    # Builds the next level on a worker thread while the current one is played, staged into staging when given.
+    # retired, from World.retire_level, is released first so the new level can reuse those entities.
+    # The thread is kept between levels, starting one per transition held the game thread up for the handshake
+    def __init__(self):
+        self.thread = None
+        self.jobs = queue.Queue()
+        self.levels = queue.Queue()
+        self.pending = False
 
-def create_world():
-    MAP = gen_map(MAP_WIDTH, MAP_HEIGHT)
-    fly_pos = [0, 0]
-    SparkCounter.count = 0
-    for j in range(0, MAP_HEIGHT):
-        for i in range(0, MAP_WIDTH):
-            tile = MAP[i + j * MAP_WIDTH]
-            if tile == 'S':
-                add_entity(
-                    Spark(i * TILE_SIZE + TILE_SIZE // 2, j * TILE_SIZE + TILE_SIZE // 2))
-                SparkCounter.count += 1
-            elif tile == 'F':
-                fly_pos = [i * TILE_SIZE + TILE_SIZE // 2, j * TILE_SIZE + TILE_SIZE // 2]
-            elif tile == 'I':
-                add_entity(Insulator(i * TILE_SIZE + TILE_SIZE // 2, j * TILE_SIZE + TILE_SIZE // 2))
-            elif tile == 'M':
-                add_entity(
-                    Minus(i * TILE_SIZE + TILE_SIZE // 2, j * TILE_SIZE + TILE_SIZE // 2))
-            elif tile == 'P':
-                add_entity(
-                    Plus(i * TILE_SIZE + TILE_SIZE // 2, j * TILE_SIZE + TILE_SIZE // 2))
-    for e_a in ENTITIES.values():
-        for e_b in ENTITIES.values():
-            if e_a.id != e_b.id:
-                e_a.components[ComponentType.Shape_].ignore(e_b)
-    fly.position = fly_pos.copy()
-    fly.start_position = fly_pos.copy()
-    fly.sparkCount = 0
-    add_entity(fly)
+    def run(self):
+        while True:
+            seed, staging, static_index, retired = self.jobs.get()
+            try:
+                if retired is not None:
+                    release_entities(*retired)
+                level = build_level(seed)
+                if staging is not None:
+                    level.stage(staging, static_index)
+            except BaseException:
+                # take() falls back to building on the game thread, the thread dies with the traceback
+                self.levels.put(None)
+                raise
+            self.levels.put(level)
+
+    def start(self, staging=None, static_index=None, retired=None):
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+        # the seed is drawn here so the level sequence doesn't depend on when the worker runs
+        self.jobs.put((random.getrandbits(63), staging, static_index, retired))
+        self.pending = True
+
+    def take(self):
+        # waits for the worker if it hasn't finished, None if nothing was started or the build failed
+        if not self.pending:
+            return None
+        self.pending = False
+        return self.levels.get()
+
+
+def world_digest(world, tick_count):
+    # fingerprint of the simulation state, used to check that a replay ended where the recording did
+    state = [tick_count, world.level_count, world.fly.sparkCount, world.fly.deathCount]
+    for entity in world.entities.values():
+        state.append((type(entity).__name__, float(entity.position[0]), float(entity.position[1])))
+    return hashlib.sha1(repr(state).encode()).digest()
+
+
+class KeyState:
+    # stands in for pygame.key.get_pressed() during a replay
+    def __init__(self, keys):
+        self.keys = keys
+
+    def __getitem__(self, key):
+        return key in self.keys
+
+
+# Input log layout, all little endian:
+# header "SFIN", version u8, MAP_GENERATOR u8, gen_map seed u64
+# per tick: keys down u8, keys clicked u8, buttons down u8, buttons clicked u16, mouse x i16, mouse y i16,
+#           then that many u32 key codes (down first, then clicked)
+# footer: 0xff, tick count u32, sha1 of world_digest
+INPUT_LOG_MAGIC = b"SFIN"
+INPUT_LOG_VERSION = 2
+INPUT_LOG_HEADER = struct.Struct("<4sBBQ")
+INPUT_LOG_TICK = struct.Struct("<BBBHhh")
+INPUT_LOG_FOOTER = struct.Struct("<BI20s")
+INPUT_LOG_END = 0xff
+
+
+def button_mask(buttons):
+    mask = 0
+    for button in buttons:
+        mask |= 1 << button
+    return mask
+
+
+class InputRecorder:
+    def __init__(self, path, seed):
+        self.file = open(path, "wb")
+        self.file.write(INPUT_LOG_HEADER.pack(INPUT_LOG_MAGIC, INPUT_LOG_VERSION, MAP_GENERATOR, seed))
+        # only keys the game asked about through is_key_down are stored, a replay asks about the same ones
+        self.keys_down = set()
+
+    def write_tick(self, game):
+        keys_clicked = [key for key, clicked in game.keys_clicked.items() if clicked]
+        buttons_down = [i + 1 for i, down in enumerate(game.buttons_down) if down]
+        buttons_clicked = [button for button, clicked in game.buttons_clicked.items() if clicked]
+        self.file.write(INPUT_LOG_TICK.pack(len(self.keys_down), len(keys_clicked), button_mask(buttons_down),
+                                            button_mask(buttons_clicked), game.mouse_position[0],
+                                            game.mouse_position[1]))
+        keys = list(self.keys_down) + keys_clicked
+        self.file.write(struct.pack("<%dI" % len(keys), *keys))
+        self.keys_down.clear()
+
+    def close(self, game):
+        self.file.write(INPUT_LOG_FOOTER.pack(INPUT_LOG_END, game.tick_count, world_digest(game.world, game.tick_count)))
+        self.file.close()
+
+
+class InputReplay:
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.data = f.read()
+        magic, version, generator, self.seed = INPUT_LOG_HEADER.unpack_from(self.data)
+        if magic != INPUT_LOG_MAGIC or version != INPUT_LOG_VERSION:
+            raise ValueError(path + " is not a SparkFly input log")
+        # the levels would differ from the recorded ones
+        if generator != MAP_GENERATOR:
+            raise ValueError("%s was recorded with map generator %d, this is %d" % (path, generator, MAP_GENERATOR))
+        self.offset = INPUT_LOG_HEADER.size
+        self.tick_count = None
+        self.digest = None
+
+    def apply(self, game):
+        # loads the next tick's input into game, stops the game at the end of the log
+        if self.data[self.offset] == INPUT_LOG_END:
+            _, self.tick_count, self.digest = INPUT_LOG_FOOTER.unpack_from(self.data, self.offset)
+            game.running = False
+            return
+        keys_down, keys_clicked, buttons_down, buttons_clicked, mouse_x, mouse_y = INPUT_LOG_TICK.unpack_from(
+            self.data, self.offset)
+        self.offset += INPUT_LOG_TICK.size
+        keys = struct.unpack_from("<%dI" % (keys_down + keys_clicked), self.data, self.offset)
+        self.offset += 4 * (keys_down + keys_clicked)
+        game.keys_down = KeyState(frozenset(keys[:keys_down]))
+        game.keys_clicked = {key: True for key in keys[keys_down:]}
+        game.buttons_down = tuple(bool(buttons_down & 1 << button) for button in (1, 2, 3))
+        game.buttons_clicked = {button: True for button in range(16) if buttons_clicked & 1 << button}
+        game.mouse_position[0] = mouse_x
+        game.mouse_position[1] = mouse_y
+
+    def matches(self, game):
+        return self.tick_count == game.tick_count and self.digest == world_digest(game.world, game.tick_count)
+
+
+def record_game(path, seed=None, headless=False):
+    if seed is None:
+        seed = random.randrange(2 ** 32)
+    random.seed(seed)
+    game = Game(headless)
+    game.recorder = InputRecorder(path, seed)
+    try:
+        game.run()
+    finally:
+        game.recorder.close(game)
+    return game
+
+
+def replay_game(path):
+    # replays a log headlessly as fast as possible, returns True when the final world state matches
+    replay = InputReplay(path)
+    random.seed(replay.seed)
+    game = Game(headless=True)
+    game.input_source = replay
+    game.run()
+    return replay.matches(game)
+
+
+class Camera:
+    # Top left corner of the visible part of the map, in world pixels
+    def __init__(self, width, height):
+        self.x = 0
+        self.y = 0
+        self.width = width
+        self.height = height
+
+    def follow(self, position, world_width, world_height):
+        # centers on position without showing anything past the map's edges
+        self.x = int(max(0, min(position[0] - self.width // 2, world_width - self.width)))
+        self.y = int(max(0, min(position[1] - self.height // 2, world_height - self.height)))
+
+    def rect(self):
+        return pygame.Rect(self.x, self.y, self.width, self.height)
+
+
+class GridIndex:
+    # Entities bucketed by the cells their shape bounds overlap, answers "what's in this rect"
+    def __init__(self, cell_size):
+        self.cell_size = cell_size
+        self.cells = {}
+
+    def build(self, entities):
+        self.cells.clear()
+        for entity in entities:
+            shape = entity.components.get(ComponentType.Shape_)
+            if shape is None:
+                continue
+            rect = shape.draw_rect()
+            min_x, min_y, max_x, max_y = shape.bounds()
+            rect.union_ip(pygame.Rect(int(min_x), int(min_y), int(max_x - min_x) + 1, int(max_y - min_y) + 1))
+            for cell_y in range(rect.top // self.cell_size, rect.bottom // self.cell_size + 1):
+                for cell_x in range(rect.left // self.cell_size, rect.right // self.cell_size + 1):
+                    self.cells.setdefault((cell_x, cell_y), []).append(entity)
+
+    def query(self, rect):
+        found = {}
+        for cell_y in range(rect.top // self.cell_size, rect.bottom // self.cell_size + 1):
+            for cell_x in range(rect.left // self.cell_size, rect.right // self.cell_size + 1):
+                for entity in self.cells.get((cell_x, cell_y), ()):
+                    found[entity.id] = entity
+        return found.values()
 
 
 class Game:
-    def __init__(self):
+    def __init__(self, headless: bool = False, profile: bool = USE_PROFILER, world=None):
         self.running = True
+        self.world = world if world is not None else WORLD
+        self.profiler = FrameProfiler(PROFILER_EXPORT_PATH) if profile else None
+        self.recorder = None
+        # replaces live input when set, anything with an apply(game) like InputReplay
+        self.input_source = None
+        self.preloader = LevelPreloader() if PRELOAD_LEVELS else None
+        # level file the first level is loaded from instead of being generated
+        self.level_path = None
+        # headless runs the simulation only, no window, no rendering
+        self.headless = headless
+        self.tick_rate = TICK_RATE
+        self.frame_rate_cap = FRAME_RATE_CAP
+        self.tick_count = 0
+        self.previous_positions = {}
         self.user_exit = False
         self.keys_clicked = {}
         self.buttons_clicked = {}
@@ -440,10 +1817,49 @@ class Game:
         self.current_frame = None
         self.width = 0
         self.height = 0
-
-    def init(self, width=WIDTH, height=HEIGHT, pixel_scale=2):
-        self.current_frame = pygame.Surface((width / pixel_scale, height / pixel_scale))
-        self.display, self.width, self.height = create_display(width, height, "SparkFly")
+        self.use_static_layer = USE_STATIC_LAYER
+        self.static_layer = None
+        self.static_layer_valid = False
+        self.static_dirty = []
+        # static entities by region, for culling and for redrawing dirty parts of the static layer
+        self.static_index = GridIndex(TILE_SIZE * 4)
+        # headless games only note that the static layer and index are out of date, see invalidate_static_layer
+        self.static_stale = False
+        # parts of a new static layer still to be drawn, one per frame
+        self.static_unbaked = []
+        self.wall_surfaces = {}
+        self.camera = None
+        # subtracted from every draw_* position, the camera position while drawing the frame
+        self.draw_offset = (0, 0)
+        self.text_cache = TextCache(TEXT_CACHE_BYTES)
+        self.pixel_scale = PIXEL_SCALE
+        self.use_dirty_rects = USE_DIRTY_RECTS
+        # textures and text drawn while batching wait in sprite_batch for flush_sprites
+        self.sprite_batch = SpriteBatch() if USE_SPRITE_BATCH else None
+        self.batching = False
+        self.draw_layer = SpriteLayer.Static_
+        # regions of current_frame drawn this frame and last frame, in frame pixels
+        self.frame_dirty = []
+        self.previous_frame_dirty = []
+        self.full_present = True
+
+    def init(self, width=WIDTH, height=HEIGHT, pixel_scale=PIXEL_SCALE):
+        self.pixel_scale = pixel_scale
+        if self.headless:
+            # the dummy driver still gives us events and key state without opening a window
+            os.environ["SDL_VIDEODRIVER"] = "dummy"
+            pygame.display.init()
+            self.width, self.height = width, height
+        else:
+            self.display, self.width, self.height = create_display(width, height, "SparkFly")
+            ASSETS.on_display_ready()
+            if self.sprite_batch is not None:
+                self.sprite_batch.atlas = TextureAtlas([ASSETS.get(name) for name in ATLAS_TEXTURES])
+        if pixel_scale == 1 and self.display is not None:
+            self.current_frame = self.display
+        else:
+            self.current_frame = pygame.Surface((width / pixel_scale, height / pixel_scale))
+        self.camera = Camera(*self.current_frame.get_size())
         pygame.font.init()
         # From Part 3
         # Map and entity initialization
@@ -466,9 +1882,15 @@ class Game:
         # player.add_component(JumpController(1, 75))
         # player.add_component(Shape(ShapeType.Circle_, [32], pygame.Color(0xff0000ff)))
         # add_entity(player)
-        create_world()
+        create_world(self.world, self.level_path)
+        self.invalidate_static_layer()
+        if self.preloader is not None:
+            self.start_preloader()
 
     def poll_input(self):
+        if self.input_source is not None:
+            self.input_source.apply(self)
+            return
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
                 self.running = False
@@ -487,9 +1909,15 @@ class Game:
             self.mouse_velocity[0] = self.mouse_position[0] - self.previous_mouse_position[0]
             self.mouse_velocity[1] = self.mouse_position[1] - self.previous_mouse_position[1]
             self.previous_mouse_position = self.mouse_position.copy()
+        if self.profiler is not None and self.is_key_clicked(pygame.K_F3):
+            self.profiler.show_hud = not self.profiler.show_hud
 
     def is_key_down(self, key):
-        return self.keys_down[key]
+        if self.keys_down[key]:
+            if self.recorder is not None:
+                self.recorder.keys_down.add(key)
+            return True
+        return False
 
     def is_key_clicked(self, key):
         return key in self.keys_clicked and self.keys_clicked[key]
@@ -511,74 +1939,410 @@ class Game:
         return 0
 
     def update(self):
-        for entity in ENTITIES.values():
+        world = self.world
+        registry = world.registry
+        profiler = self.profiler
+        if profiler is not None:
+            profiler.start("update.entities")
+        if world.store is not None:
+            world.store.step_drift()
+        for entity in registry.custom_updating.values():
             entity.update(self)
-        for e_a in ENTITIES.values():
-            for e_b in ENTITIES.values():
-                if e_a.id != e_b.id:
-                    try:
-                        e_a.components[ComponentType.Shape_].colliding_with(e_b.components[ComponentType.Shape_])
-                    except KeyError:
-                        pass
-        for eid in TO_REMOVE:
-            ENTITIES.pop(eid)
-        TO_REMOVE.clear()
+        for component_type in registry.update_order:
+            # the store already moved everything that drifts
+            if component_type == ComponentType.Drift_ and world.store is not None:
+                continue
+            if profiler is not None:
+                profiler.start("update." + COMPONENT_NAMES[component_type])
+            for component in registry.updating[component_type].values():
+                component.update(self)
+            if profiler is not None:
+                profiler.stop("update." + COMPONENT_NAMES[component_type])
+        if profiler is not None:
+            profiler.stop("update.entities")
+            profiler.start("update.collision")
+        fly = world.fly
+        if world.field is not None:
+            world.field.apply(fly)
+        if world.tiles is not None and world.tiles.circle_hits(fly.position[0], fly.position[1],
+                                                               fly.scale * FLY_RADIUS):
+            _insulator_collide(fly)
+        broadphase = world.broadphase
+        pairs = list(broadphase.pairs(world.moving.values()))
+        hits = 0
+        for shape_a, shape_b in broadphase.resting():
+            if shape_b.entity.id not in shape_a.ignored_entities:
+                shape_a.on_collide(shape_a.entity, shape_b.entity)
+                hits += 1
+        if np is not None and len(pairs) >= BATCH_NARROWPHASE_MIN_PAIRS:
+            for shape_a, shape_b in batch_narrowphase(pairs):
+                shape_a.on_collide(shape_a.entity, shape_b.entity)
+                broadphase.touching(shape_a, shape_b)
+                hits += 1
+        else:
+            for shape_a, shape_b in pairs:
+                if shape_a.colliding_with(shape_b):
+                    broadphase.touching(shape_a, shape_b)
+                    hits += 1
+        if profiler is not None:
+            profiler.stop("update.collision")
+            profiler.add("pairs.tested", len(pairs))
+            profiler.add("pairs.hit", hits)
+            profiler.start("update.remove")
+        for entity in world.sweep():
+            if entity.static:
+                # draw_rect may load the texture, headless games don't need the area
+                shape = None if self.headless else entity.components.get(ComponentType.Shape_)
+                self.invalidate_static_layer(shape.draw_rect() if shape is not None else None)
+            ENTITY_POOL.release(entity)
+        if profiler is not None:
+            profiler.stop("update.remove")
         # Part 4
-        pygame.display.set_caption("SparkyFly | Deaths "+str(fly.deathCount))
-        if fly.sparkCount >= SparkCounter.count:
-            LevelCounter.count += 1
-            ENTITIES.clear()
-            if LevelCounter.count < 10:
-                create_world()
+        if not self.headless:
+            pygame.display.set_caption("SparkyFly | Deaths "+str(world.fly.deathCount))
+        if world.fly.sparkCount >= world.spark_count:
+            world.level_count += 1
+            if world.level_count < 10:
+                # a preloaded level is already staged, so this costs about as much as a normal tick
+                level = self.preloader.take() if self.preloader is not None else None
+                retired = world.retire_level()
+                if level is None:
+                    release_entities(*retired)
+                    retired = None
+                    level = build_level()
+                world.install_level(level)
+                self.invalidate_static_layer(index=level.static_index)
+                if self.preloader is not None and world.level_count < 9:
+                    self.start_preloader(retired)
+                elif retired is not None:
+                    release_entities(*retired)
             else:
-                exit()
+                world.clear()
+                self.running = False
+
+    def start_preloader(self, retired=None):
+        # the next level is staged into a world set up like this one, its statics indexed unless headless
+        static_index = None if self.headless else GridIndex(self.static_index.cell_size)
+        self.preloader.start(self.world.staging(), static_index, retired)
 
     def clear_input(self):
         self.keys_clicked.clear()
         self.buttons_clicked.clear()
 
+    def flush_sprites(self):
+        if self.batching:
+            self.frame_dirty.extend(self.sprite_batch.flush(self.current_frame))
+
     def clear(self):
         # clears to black
+        self.flush_sprites()
         self.current_frame.fill(pygame.Color(0x000000ff))
 
     def draw_circle(self, x: int, y: int, radius: int, color: pygame.Color):
-        pygame.draw.circle(self.current_frame, color, (x, y), radius)
+        # shapes can't be batched, so whatever is waiting is drawn first to keep the order
+        self.flush_sprites()
+        ox, oy = self.draw_offset
+        self.frame_dirty.append(pygame.draw.circle(self.current_frame, color, (x - ox, y - oy), radius))
 
     def draw_box(self, x: int, y: int, width: int, height: int, color: pygame.Color, center: bool = False):
-        pos = (x, y) if not center else (x - width // 2, y - height // 2)
-        pygame.draw.rect(self.current_frame, color, (pos[0], pos[1], width, height))
+        self.flush_sprites()
+        ox, oy = self.draw_offset
+        pos = (x - ox, y - oy) if not center else (x - ox - width // 2, y - oy - height // 2)
+        self.frame_dirty.append(pygame.draw.rect(self.current_frame, color, (pos[0], pos[1], width, height)))
 
     def draw_line(self, sx: int, sy: int, ex: int, ey: int, color: pygame.Color, thickness: int = 1):
-        pygame.draw.line(self.current_frame, color, (sx, sy), (ex, ey), thickness)
+        self.flush_sprites()
+        ox, oy = self.draw_offset
+        self.frame_dirty.append(
+            pygame.draw.line(self.current_frame, color, (sx - ox, sy - oy), (ex - ox, ey - oy), thickness))
 
     def draw_text(self, txt: str, x: int, y: int, size: int, color: pygame.Color, center: bool = False):
-        f = pygame.font.Font(None, size)
-        font_screen = f.render(txt, True, color)
-        pos = (x, y) if not center else (x - font_screen.get_width() // 2, y - font_screen.get_height() // 2)
-        self.current_frame.blit(font_screen, pos)
+        ox, oy = self.draw_offset
+        font_screen = self.text_cache.render(txt, size, color)
+        pos = (x - ox, y - oy) if not center else (
+            x - ox - font_screen.get_width() // 2, y - oy - font_screen.get_height() // 2)
+        if self.batching:
+            self.sprite_batch.add(SpriteLayer.Text_, font_screen, pos)
+        else:
+            self.frame_dirty.append(self.current_frame.blit(font_screen, pos))
 
     def draw_texture(self, x: int, y: int, texture_frame, center: bool = False):
-        pos = (x, y) if not center else (x - texture_frame.get_width() // 2, y - texture_frame.get_height() // 2)
-        self.current_frame.blit(texture_frame, pos)
+        ox, oy = self.draw_offset
+        pos = (x - ox, y - oy) if not center else (
+            x - ox - texture_frame.get_width() // 2, y - oy - texture_frame.get_height() // 2)
+        if self.batching:
+            self.sprite_batch.add(self.draw_layer, texture_frame, pos)
+        else:
+            self.frame_dirty.append(self.current_frame.blit(texture_frame, pos))
+
+    def invalidate_static_layer(self, rect=None, index=None):
+        # rect limits the redraw to one region, None rebakes the whole layer and index is a GridIndex already
+        # built for the new static entities, if there is one.
+        # Most headless games never render, so they skip the bookkeeping and render rebuilds it all when they do
+        if self.headless:
+            self.static_stale = True
+        elif rect is None:
+            self.rebuild_static(index)
+        elif self.static_layer_valid:
+            self.static_dirty.append(rect)
+
+    def rebuild_static(self, index=None):
+        self.static_stale = False
+        self.static_layer_valid = False
+        self.static_dirty.clear()
+        if index is not None:
+            self.static_index = index
+        else:
+            self.static_index.build(entity for entity in self.world.registry.drawing.values() if entity.static)
 
-    def render(self):
-        for entity in ENTITIES.values():
+    def draw_walls(self, rect=None):
+        # one blit per merged wall run, rect limits it to the runs touching that area
+        tiles = self.world.tiles
+        if tiles is None:
+            return
+        for run in tiles.runs if rect is None else tiles.runs_in(rect):
+            self.draw_texture(run.x, run.y, self.wall_surface(run.size))
+
+    def wall_surface(self, size):
+        # the insulator texture tiled to fill a wall run, kept per run size
+        surface = self.wall_surfaces.get(size)
+        if surface is None:
+            texture = ASSETS.get(insulator_tex)
+            surface = pygame.Surface(size, pygame.SRCALPHA)
+            for y in range(0, size[1], texture.get_height()):
+                for x in range(0, size[0], texture.get_width()):
+                    surface.blit(texture, (x, y))
+            if pygame.display.get_surface() is not None:
+                surface = surface.convert_alpha()
+            self.wall_surfaces[size] = surface
+        return surface
+
+    def static_entities_in(self, rect):
+        # the index isn't rebuilt when entities leave, so skip the ones no longer in the world
+        return [entity for entity in self.static_index.query(rect) if entity.world is self.world]
+
+    def draw_static_layer(self):
+        # the layer covers the whole map, returns False when that would be bigger than STATIC_LAYER_MAX_PIXELS
+        # or while a new layer is still being drawn. That takes a view sized piece per frame so a level change
+        # doesn't draw the whole map at once, render draws the visible statics itself until then
+        map_width, map_height = self.map_size()
+        size = (max(map_width, self.camera.width), max(map_height, self.camera.height))
+        if size[0] * size[1] > STATIC_LAYER_MAX_PIXELS:
+            self.static_layer = None
+            return False
+        # draw_* always target current_frame in world space, so point it at the static layer while baking
+        frame = self.current_frame
+        frame_dirty = self.frame_dirty
+        draw_offset = self.draw_offset
+        self.current_frame = self.static_layer
+        self.frame_dirty = []
+        self.draw_offset = (0, 0)
+        if not self.static_layer_valid or self.static_layer is None or self.static_layer.get_size() != size:
+            if self.static_layer is None or self.static_layer.get_size() != size:
+                self.static_layer = self.current_frame = pygame.Surface(size)
+            width, height = self.camera.width, self.camera.height
+            self.static_unbaked = [pygame.Rect(x, y, width, height)
+                                   for y in range(0, size[1], height) for x in range(0, size[0], width)]
+            self.static_layer_valid = True
+            # the last frame took its statics from the old layer, so no dirty rect covers them
+            self.full_present = True
+            self.static_dirty.clear()
+        if self.static_unbaked:
+            self.static_dirty.append(self.static_unbaked.pop())
+        for rect in self.static_dirty:
+            frame_dirty.append(rect.move(-draw_offset[0], -draw_offset[1]))
+            self.static_layer.set_clip(rect)
+            self.clear()
+            self.draw_walls(rect)
+            for entity in self.static_entities_in(rect):
+                entity.draw(self)
+            # blits only respects the clip it's called under
+            self.flush_sprites()
+        self.static_layer.set_clip(None)
+        self.static_dirty.clear()
+        self.current_frame = frame
+        self.frame_dirty = frame_dirty
+        self.draw_offset = draw_offset
+        return not self.static_unbaked
+
+    def in_view(self, entity, view):
+        shape = entity.components.get(ComponentType.Shape_)
+        return shape is None or view.colliderect(shape.draw_rect())
+
+    def draw_entity(self, entity, alpha: float = 1.0):
+        # draws moving entities between their last two simulated positions
+        previous = self.previous_positions.get(entity.id)
+        if alpha >= 1 or previous is None:
+            entity.draw(self)
+            return
+        x, y = entity.position[0], entity.position[1]
+        dx = x - previous[0]
+        dy = y - previous[1]
+        # teleports (respawns) snap instead of sliding across the map
+        if abs(dx) > TILE_SIZE or abs(dy) > TILE_SIZE:
             entity.draw(self)
+            return
+        entity.position = [previous[0] + dx * alpha, previous[1] + dy * alpha]
+        entity.draw(self)
+        entity.position = [x, y]
+
+    def map_size(self):
+        # in world pixels, taken from the level being played rather than the size new levels are generated at
+        tiles = self.world.tiles
+        if tiles is None:
+            return MAP_WIDTH * TILE_SIZE, MAP_HEIGHT * TILE_SIZE
+        return tiles.width * tiles.tile_size, tiles.height * tiles.tile_size
+
+    def render(self, alpha: float = 1.0):
+        if self.static_stale:
+            self.rebuild_static()
+        self.camera.follow(self.world.fly.position, *self.map_size())
+        if self.draw_offset != (self.camera.x, self.camera.y):
+            self.draw_offset = (self.camera.x, self.camera.y)
+            self.full_present = True
+        view = self.camera.rect()
+        self.batching = self.sprite_batch is not None
+        self.draw_layer = SpriteLayer.Static_
+        if self.use_static_layer and self.draw_static_layer():
+            self.current_frame.blit(self.static_layer, (0, 0), view)
+        else:
+            self.draw_walls(view)
+            for entity in self.static_entities_in(view):
+                entity.draw(self)
+        self.draw_layer = SpriteLayer.Moving_
+        for entity in self.world.registry.drawing.values():
+            if not entity.static and self.in_view(entity, view):
+                self.draw_entity(entity, alpha)
+        self.flush_sprites()
+        self.batching = False
+        if self.profiler is not None and self.profiler.show_hud:
+            # the overlay is drawn in screen space
+            self.draw_offset = (0, 0)
+            self.profiler.draw(self)
+            self.draw_offset = (self.camera.x, self.camera.y)
+
+    def present_rect(self, rect):
+        # copies one frame region to the window with a nearest neighbour integer scale, returns the window rect
+        scale = self.pixel_scale
+        display_rect = pygame.Rect(rect.x * scale, rect.y * scale, rect.w * scale, rect.h * scale)
+        if self.current_frame is not self.display:
+            pygame.transform.scale(self.current_frame.subsurface(rect), display_rect.size,
+                                   self.display.subsurface(display_rect))
+        return display_rect
 
     def swap_frame(self):
-        self.display.blit(pygame.transform.scale(self.current_frame, self.display.get_rect().size), (0, 0))
-        pygame.display.update()
-        pygame.display.flip()
-
-    def run(self):
+        frame_rect = self.current_frame.get_rect()
+        rects = []
+        if self.use_dirty_rects and not self.full_present and isinstance(self.pixel_scale, int):
+            area = 0
+            for rect in self.previous_frame_dirty + self.frame_dirty:
+                rect = rect.clip(frame_rect)
+                if rect.w and rect.h:
+                    rects.append(rect)
+                    area += rect.w * rect.h
+            # past half the frame one full present is cheaper than many small ones
+            if area > frame_rect.w * frame_rect.h // 2:
+                rects = None
+        else:
+            rects = None
+        if rects is None:
+            if self.current_frame is not self.display:
+                pygame.transform.scale(self.current_frame, self.display.get_size(), self.display)
+            pygame.display.flip()
+        elif rects:
+            pygame.display.update([self.present_rect(rect) for rect in rects])
+        self.previous_frame_dirty = self.frame_dirty
+        self.frame_dirty = []
+        self.full_present = False
+
+    def tick(self):
+        self.previous_positions = {entity.id: (entity.position[0], entity.position[1])
+                                   for entity in self.world.moving.values()}
+        self.update()
+        self.tick_count += 1
+        if self.recorder is not None:
+            self.recorder.write_tick(self)
+        self.clear_input()
+
+    def run_headless(self, max_ticks=None):
+        # ticks back to back as fast as the machine allows
+        profiler = self.profiler
+        while self.running and (max_ticks is None or self.tick_count < max_ticks):
+            if profiler is not None:
+                profiler.start("input")
+            self.poll_input()
+            if not self.running:
+                break
+            if profiler is not None:
+                profiler.stop("input")
+                profiler.start("update")
+            self.tick()
+            if profiler is not None:
+                profiler.stop("update")
+                profiler.end_frame()
+
+    def run(self, max_ticks=None):
         self.init()
-        while self.running:
+        if self.headless:
+            self.run_headless(max_ticks)
+            return
+        clock = pygame.time.Clock()
+        tick_time = 1 / self.tick_rate
+        accumulator = 0.0
+        previous_time = time.perf_counter()
+        profiler = self.profiler
+        while self.running and (max_ticks is None or self.tick_count < max_ticks):
+            now = time.perf_counter()
+            accumulator += min(now - previous_time, MAX_FRAME_TIME)
+            previous_time = now
+            if profiler is not None:
+                profiler.start("input")
             self.poll_input()
-            self.update()
-            self.clear_input()
+            if profiler is not None:
+                profiler.stop("input")
+                profiler.start("update")
+            while accumulator >= tick_time and self.running:
+                self.tick()
+                accumulator -= tick_time
+            if profiler is not None:
+                profiler.stop("update")
+                profiler.start("render")
             self.clear()
-            self.render()
+            self.render(accumulator / tick_time)
+            if profiler is not None:
+                profiler.stop("render")
+                profiler.start("present")
             self.swap_frame()
-
-
-Game().run()
+            if profiler is not None:
+                profiler.stop("present")
+                profiler.end_frame()
+            if self.frame_rate_cap:
+                clock.tick(self.frame_rate_cap)
+
+
+if __name__ == "__main__":
+    if "--map-scale" in sys.argv:
+        MAP_SCALE = int(sys.argv[sys.argv.index("--map-scale") + 1])
+        MAP_WIDTH = HALF_WIDTH // TILE_SIZE * MAP_SCALE
+        MAP_HEIGHT = HALF_HEIGHT // TILE_SIZE * MAP_SCALE
+    # --save-level <file> [--seed N] writes a generated level to disk, --level <file> starts the game on one
+    level_path = None
+    if "--level" in sys.argv:
+        level_path = sys.argv[sys.argv.index("--level") + 1]
+        MAP_WIDTH, MAP_HEIGHT = load_level(level_path)[:2]
+    # --record <log> saves this run's input, --replay <log> plays one back headless and checks the result
+    if "--save-level" in sys.argv:
+        level_seed = int(sys.argv[sys.argv.index("--seed") + 1]) if "--seed" in sys.argv else random.getrandbits(63)
+        save_level(sys.argv[sys.argv.index("--save-level") + 1], MAP_WIDTH, MAP_HEIGHT, level_seed,
+                   gen_map(MAP_WIDTH, MAP_HEIGHT, level_seed))
+        print("saved %dx%d level with seed %d" % (MAP_WIDTH, MAP_HEIGHT, level_seed))
+    elif "--replay" in sys.argv:
+        matched = replay_game(sys.argv[sys.argv.index("--replay") + 1])
+        print("replay matches recording" if matched else "replay diverged from recording")
+        sys.exit(0 if matched else 1)
+    elif "--record" in sys.argv:
+        record_game(sys.argv[sys.argv.index("--record") + 1], headless="--headless" in sys.argv)
+    else:
+        game = Game(headless="--headless" in sys.argv, profile=USE_PROFILER or "--profile" in sys.argv)
+        game.level_path = level_path
+        game.run()
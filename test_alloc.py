@@ -0,0 +1,131 @@
+import gc
+import os
+import random
+import tracemalloc
+
+# Ticks run headless, never opens a window
+os.environ["SDL_VIDEODRIVER"] = "dummy"
+os.environ["SDL_AUDIODRIVER"] = "dummy"
+
+import main
+
+# past the small int cache, so tick_count's int is already a traced allocation
+WARMUP_TICKS = 300
+MEASURED_TICKS = 200
+
+
+class IdleInput:
+    # holds no keys, plugs into Game.input_source
+    def apply(self, game):
+        game.keys_down = main.KeyState(frozenset())
+        game.keys_clicked = {}
+
+
+def frozen_game(broadphase):
+    random.seed(0)
+    world = main.World()
+    world.broadphase = broadphase
+    game = main.Game(headless=True, world=world)
+    game.preloader = None
+    game.input_source = IdleInput()
+    game.init()
+    # nothing moves: the fly neither drifts nor steers and no field pulls on it
+    fly = world.fly
+    world.registry.remove(fly)
+    del fly.components[main.ComponentType.Drift_]
+    del fly.components[main.ComponentType.Controller_]
+    world.registry.add(fly)
+    world.field = None
+    # a box and a circle resting on the fly, so every tick has overlapping pairs for the narrowphase
+    for shape_type, size in ((main.ShapeType.Box_, (12, 12)), (main.ShapeType.Circle_, (6,))):
+        obstacle = main.Entity()
+        obstacle.position = list(fly.position)
+        obstacle.static = True
+        shape = main.Shape(shape_type, size, main.WHITE)
+        shape.layer = main.CollisionLayer.Static_
+        shape.mask = main.CollisionLayer.Player_
+        obstacle.add_component(shape)
+        main.add_entity(obstacle, world)
+    return game
+
+
+def narrowphase(pairs):
+    for shape_a, shape_b in pairs:
+        shape_a.colliding_with(shape_b)
+
+
+def loop_only(pairs):
+    for shape_a, shape_b in pairs:
+        pass
+
+
+def peak_during(function, pairs):
+    # bytes allocated at the busiest point of the call, freed or not
+    tracemalloc.reset_peak()
+    start = tracemalloc.get_traced_memory()[0]
+    function(pairs)
+    return tracemalloc.get_traced_memory()[1] - start
+
+
+def test_narrowphase_allocates_nothing():
+    # brute force tests every pair every tick, the spatial hash would let the resting ones sleep
+    game = frozen_game(main.BruteForceBroadphase())
+    world = game.world
+    tracemalloc.start()
+    try:
+        gc.collect()
+        for _ in range(WARMUP_TICKS):
+            game.tick()
+        pairs = list(world.broadphase.pairs(world.moving.values()))
+        hits = [(shape_a, shape_b) for shape_a, shape_b in pairs if shape_a.colliding_with(shape_b)]
+        world_shapes = {shape: shape.world_shape() for pair in pairs for shape in pair}
+        # the loop's own iterator is the only allocation allowed
+        overhead = peak_during(loop_only, pairs)
+        allocated = 0
+        for _ in range(MEASURED_TICKS):
+            game.tick()
+            allocated = max(allocated, peak_during(narrowphase, pairs))
+    finally:
+        tracemalloc.stop()
+    # fly against box and circle, both ways round
+    assert len(hits) == 4
+    assert allocated <= overhead, "%d B allocated testing %d pairs, the bare loop takes %d B" % (
+        allocated, len(pairs), overhead)
+    # nothing moved, so every shape still hands out the tuple it built before the measured ticks
+    rebuilt = [shape for shape, world_shape in world_shapes.items() if shape.world_shape() is not world_shape]
+    assert not rebuilt, "%d of %d shapes rebuilt their world shape" % (len(rebuilt), len(world_shapes))
+
+
+def test_static_scene_tick_does_not_grow_memory():
+    for broadphase in (main.SpatialHashBroadphase(main.TILE_SIZE), main.BruteForceBroadphase()):
+        tracemalloc.start()
+        try:
+            # empties the free lists, their blocks were allocated before tracing and would turn up as new ones
+            gc.collect()
+            game = frozen_game(broadphase)
+            for _ in range(WARMUP_TICKS):
+                game.tick()
+            gc.collect()
+            # free lists hand a block allocated on one line to the next line asking for one, so the per line
+            # numbers shuffle a little while the total only moves when something is really kept
+            filters = [tracemalloc.Filter(True, main.__file__)]
+            before = tracemalloc.take_snapshot().filter_traces(filters)
+            start = tracemalloc.get_traced_memory()[0]
+            for _ in range(MEASURED_TICKS):
+                game.tick()
+            gc.collect()
+            grown = tracemalloc.get_traced_memory()[0] - start
+            after = tracemalloc.take_snapshot().filter_traces(filters)
+        finally:
+            tracemalloc.stop()
+        assert grown <= 0, "%s: %d B more after %d ticks\n%s" % (
+            type(broadphase).__name__, grown, MEASURED_TICKS,
+            "\n".join(str(stat) for stat in after.compare_to(before, "lineno") if stat.size_diff))
+        assert game.tick_count == WARMUP_TICKS + MEASURED_TICKS
+        assert game.world.fly.deathCount == 0 and game.world.fly.sparkCount == 0
+
+
+if __name__ == "__main__":
+    test_narrowphase_allocates_nothing()
+    test_static_scene_tick_does_not_grow_memory()
+    print("ok")